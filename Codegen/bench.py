@@ -0,0 +1,269 @@
+from lex import lexer
+from codaparser import Parser
+from parse import parse_table
+from codagen import CodaGenerator
+from codair import expand
+from midi import MidiGenerator, BACKENDS, AVAILABLE_BACKENDS
+from coda import COMPILER_VERSION
+
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+NOTES = ['C4', 'D4', 'E4', 'F#4', 'G4', 'A4', 'Bb4', 'C5', 'Db5', 'Eb3', 'G#3', 'B2']
+CHORDS = ['C+4*', 'F+4*', 'G+3*', 'D-5*', 'A-4*', 'C#-3*', 'E+5*', 'Bb+4*']
+LINE_NOTES = 10  # Notes per source line
+NEST_DEPTH = 12  # Levels of each nested unit in the 'nested' profile
+COMMENT_WIDTH = 200  # Characters of each comment line in the 'comments' profile
+STAGES = ('lexer', 'parser', 'codegen', 'midi')
+
+
+def header(r):
+    '''Returns the global modifiers every score starts with'''
+    return f"!key[{r.choice(['Bb-', 'F+', 'C-'])}]\n!sig[4, 4]\n!tmp[{r.randint(60, 200)}]\n"
+
+
+def line(r, pool, count=LINE_NOTES):
+    '''Returns count notes from pool joined by connectors, with some rests after the first'''
+    return '>>'.join([r.choice(pool)] + [r.choice(pool) if r.random() > 0.1 else '_' for _ in range(count - 1)])
+
+
+def flat_score(r, size):
+    '''One block holding size notes'''
+    lines = [line(r, NOTES) for _ in range(max(size // LINE_NOTES, 1))]
+    return header(r) + 'typ[1]{\n' + '\n'.join(lines) + '\n}\n'
+
+
+def nested_score(r, size):
+    '''Units of NEST_DEPTH nested blocks with a line of notes at every level'''
+    units = []
+    for _ in range(max(size // (4 * NEST_DEPTH), 1)):
+        unit = line(r, NOTES, 4)
+        for depth in range(NEST_DEPTH):
+            unit = f"typ[{r.randint(1, 4)}]{{\n{line(r, NOTES, 4)}\n{unit}\n}}"
+        units.append(unit)
+    return header(r) + '\n'.join(units) + '\n'
+
+
+def repgrp_score(r, size):
+    '''Short blocks that nearly all repeat, group or both'''
+    blocks = []
+    for _ in range(max(size // 8, 1)):
+        group = ' '.join(r.choice(NOTES) for _ in range(4))
+        blocks.append(f"rep[{r.randint(2, 4)}]{{ grp[{r.randint(1, 3)}]{{{group}}} "
+                      f"typ[2]{{{line(r, NOTES + CHORDS, 4)}}} }}")
+    return header(r) + '\n'.join(blocks) + '\n'
+
+
+def comments_score(r, size):
+    '''A flat stream with a long comment before every line'''
+    lines = []
+    for n in range(max(size // LINE_NOTES, 1)):
+        text = ''.join(r.choice('abcdefghij klmnopqrst ,.[]{}>_!') for _ in range(COMMENT_WIDTH))
+        lines.append(f"// {n} {text}\n{line(r, NOTES)}")
+    return header(r) + 'typ[1]{\n' + '\n'.join(lines) + '\n}\n'
+
+
+def chords_score(r, size):
+    '''A flat stream of chords'''
+    lines = [line(r, CHORDS) for _ in range(max(size // LINE_NOTES, 1))]
+    return header(r) + 'typ[2]{\n' + '\n'.join(lines) + '\n}\n'
+
+
+PROFILES = {
+    'flat': flat_score,
+    'nested': nested_score,
+    'repgrp': repgrp_score,
+    'comments': comments_score,
+    'chords': chords_score,
+}
+
+
+def score(profile, size, seed=0):
+    '''Returns the text of a synthetic Coda score of the given profile with about size source notes'''
+    return PROFILES[profile](random.Random(seed), size)
+
+
+def run_stages(text, tpq, backend):
+    '''Compiles text one stage at a time. Returns (seconds per stage, token count, note count).'''
+    seconds = {}
+    start = time.perf_counter()
+    call_lexer = lexer.copy()
+    call_lexer.tokenize_text(text)
+    tokens = call_lexer.get_tokens()
+    seconds['lexer'] = time.perf_counter() - start
+    ntokens = len(tokens)
+
+    start = time.perf_counter()
+    parser = Parser(tokens, parse_table, 'S')
+    parser.parse()
+    seconds['parser'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    generator = CodaGenerator(parser.root, tpq=tpq)
+    seq = generator.get_sequence()
+    seconds['codegen'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    MidiGenerator(generator.tempo, expand(seq, repeats=True), tpq, backend).encode()
+    seconds['midi'] = time.perf_counter() - start
+
+    notes = sum(1 for event in expand(seq) if event.pitches)  # Notes and chords as performed
+    return seconds, ntokens, notes
+
+
+def peak_memory(text, tpq, backend):
+    '''
+    Returns the peak traced memory, in bytes, while each stage compiles text. Earlier
+    stages' output (ex. the tokens while parsing) is still live and counted.
+    '''
+    peaks = {}
+    tracemalloc.start()
+    try:
+        call_lexer = lexer.copy()
+        call_lexer.tokenize_text(text)
+        tokens = call_lexer.get_tokens()
+        peaks['lexer'] = tracemalloc.get_traced_memory()[1]
+
+        tracemalloc.reset_peak()
+        parser = Parser(tokens, parse_table, 'S')
+        parser.parse()
+        peaks['parser'] = tracemalloc.get_traced_memory()[1]
+
+        tracemalloc.reset_peak()
+        generator = CodaGenerator(parser.root, tpq=tpq)
+        seq = generator.get_sequence()
+        peaks['codegen'] = tracemalloc.get_traced_memory()[1]
+
+        tracemalloc.reset_peak()
+        MidiGenerator(generator.tempo, expand(seq, repeats=True), tpq, backend).encode()
+        peaks['midi'] = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return peaks
+
+
+def benchmark(profiles, sizes, repeat=3, tpq=480, backend='python', memory=True):
+    '''
+    Times each stage on a score of every profile and size, keeping the best of repeat
+    runs, and returns one result dict per (profile, size, stage). Peak memory is
+    measured in a separate traced run so tracing does not skew the timings.
+    '''
+    results = []
+    for profile in profiles:
+        for size in sizes:
+            text = score(profile, size)
+            runs = [run_stages(text, tpq, backend) for _ in range(repeat)]
+            _, ntokens, notes = runs[0]
+            peaks = peak_memory(text, tpq, backend) if memory else {}
+            for stage in STAGES:
+                seconds = min(run[0][stage] for run in runs)
+                results.append({
+                    'profile': profile,
+                    'size': size,
+                    'stage': stage,
+                    'bytes': len(text),
+                    'tokens': ntokens,
+                    'notes': notes,
+                    'seconds': seconds,
+                    'tokens_per_s': ntokens / seconds if seconds else None,
+                    'notes_per_s': notes / seconds if seconds else None,
+                    'peak_bytes': peaks.get(stage),
+                })
+    return results
+
+
+def compare(results, baseline, tolerance=0.25):
+    '''
+    Pairs results with the baseline entries of the same profile, size and stage.
+    Returns (result, baseline seconds, ratio) triples for the pairs that are more than
+    tolerance slower than the baseline.
+    '''
+    stored = {(b['profile'], b['size'], b['stage']): b['seconds'] for b in baseline['results']}
+    slower = []
+    for result in results:
+        before = stored.get((result['profile'], result['size'], result['stage']))
+        if before:
+            ratio = result['seconds'] / before
+            result['baseline_ratio'] = ratio
+            if ratio > 1 + tolerance:
+                slower.append((result, before, ratio))
+    return slower
+
+
+def rate(value, width=12):
+    '''Formats a rate or size column, '-' when it was not measured'''
+    return f"{value:{width}.0f}" if value is not None else f"{'-':>{width}}"
+
+
+def report(results, out=sys.stdout):
+    '''Prints results as a table'''
+    print(f"{'profile':<10}{'size':>8}  {'stage':<8}{'seconds':>10}{'tokens/s':>12}"
+          f"{'notes/s':>12}{'peak KiB':>10}{'vs base':>9}", file=out)
+    for r in results:
+        peak = rate(r['peak_bytes'] and r['peak_bytes'] / 1024, 10)
+        ratio = f"{r['baseline_ratio']:8.2f}x" if 'baseline_ratio' in r else f"{'-':>9}"
+        print(f"{r['profile']:<10}{r['size']:>8}  {r['stage']:<8}{r['seconds']:10.4f}"
+              f"{rate(r['tokens_per_s'])}{rate(r['notes_per_s'])}{peak}{ratio}", file=out)
+
+
+def main():
+    argparser = argparse.ArgumentParser(description='Benchmarks each compiler stage on synthetic scores.')
+    argparser.add_argument('-p', '--profiles', nargs='+', choices=PROFILES, default=list(PROFILES),
+                           help='Kinds of score to generate.')
+    argparser.add_argument('-s', '--sizes', nargs='+', type=int, default=[1000, 4000, 16000],
+                           help='Approximate source notes per score.')
+    argparser.add_argument('-r', '--repeat', type=int, default=3, help='Runs per score; the fastest is kept.')
+    argparser.add_argument('--tpq', type=int, default=480, help='MIDI ticks per quarter note.')
+    argparser.add_argument('--backend', choices=BACKENDS, default='python', help='MIDI encoder to time.')
+    argparser.add_argument('--no-memory', action='store_true', help='Skip the traced peak memory run.')
+    argparser.add_argument('-o', '--output', metavar='FILE', help='Write the results to FILE as JSON.')
+    argparser.add_argument('--baseline', metavar='FILE', help='Compare against results stored with -o.')
+    argparser.add_argument('--tolerance', type=float, default=0.25,
+                           help='Slowdown over the baseline, as a fraction, reported as a regression.')
+    argparser.add_argument('--dump', nargs=2, metavar=('PROFILE', 'SIZE'),
+                           help='Print the generated score instead of benchmarking.')
+
+    args = argparser.parse_args()
+    if args.backend not in AVAILABLE_BACKENDS:
+        argparser.error(f"the {args.backend} backend is not available; install NumPy to use it")
+    if args.dump:
+        profile, size = args.dump
+        if profile not in PROFILES:
+            argparser.error(f"unknown profile '{profile}'")
+        sys.stdout.write(score(profile, int(size)))
+        return
+
+    results = benchmark(args.profiles, args.sizes, args.repeat, args.tpq, args.backend, not args.no_memory)
+    slower = []
+    if args.baseline:
+        with open(args.baseline) as infile:
+            slower = compare(results, json.load(infile), args.tolerance)
+    report(results)
+
+    if args.output:
+        run = {
+            'compiler_version': COMPILER_VERSION,
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'backend': args.backend,
+            'tpq': args.tpq,
+            'repeat': args.repeat,
+            'results': results,
+        }
+        with open(args.output, 'w') as outfile:
+            json.dump(run, outfile, indent=2)
+
+    for result, before, ratio in slower:
+        print(f"SLOWER {result['profile']} {result['size']} {result['stage']}: "
+              f"{before:.4f}s -> {result['seconds']:.4f}s ({ratio:.2f}x)")
+    if slower:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
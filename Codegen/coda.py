@@ -2,30 +2,226 @@ from lex import lexer
 from codaparser import Parser
 from parse import parse_table
 from codagen import CodaGenerator
+from codacache import CompileCache, DEFAULT_MAX_BYTES
+from midi import BACKENDS, AVAILABLE_BACKENDS
 
+from concurrent.futures import ProcessPoolExecutor
 import argparse
+import glob
+import io
+import os
 import sys
+import time
 
-argparser = argparse.ArgumentParser()
-argparser.add_argument('-i', '--input-file', required=True, help='Input file for MIDI conversion.')
-argparser.add_argument('-o', '--output-file', default='output', help='Output file name')
+COMPILER_VERSION = '1.3'  # Part of every cache key; change whenever compiled output changes
 
-args = argparser.parse_args()
 
-# Lexical Analysis
-try:
-    lexer.tokenize(args.input_file)
-except FileNotFoundError:
-    print(f"Invalid file path supplied: '{args.input_file}'")
-    sys.exit()
+def cache_version(tracks=False):
+    '''Returns the version part of cache keys for output in the given format'''
+    return f"{COMPILER_VERSION}/tracks" if tracks else COMPILER_VERSION
 
-token_list = lexer.get_tokens()
 
-# Synctactic Analysis
-parser = Parser(token_list, parse_table, 'S')
-parser.parse()
+def code_generator(lexer, tpq=480, blocks=None, backend='python', tracks=False, executor=None):
+    '''Parses a lexer's tokens and returns the CodaGenerator for the sheet.'''
+    # Synctactic Analysis
+    parser = Parser(lexer.get_tokens(), parse_table, 'S')
+    parser.parse()
 
-# Code Generation
-ast_root = parser.root
-gen = CodaGenerator(ast_root, args.output_file)
-gen.generate()
\ No newline at end of file
+    return CodaGenerator(parser.root, tpq=tpq, blocks=blocks, backend=backend, tracks=tracks, executor=executor)
+
+
+def compile_tokens(lexer, tpq=480, blocks=None, backend='python', tracks=False):
+    '''Parses a lexer's tokens and returns the MIDI file as bytes.'''
+    # Code Generation
+    return code_generator(lexer, tpq, blocks, backend, tracks).midi_bytes()
+
+
+def compile_source(text, tpq=480, cache=None, blocks=None, backend='python', tracks=False):
+    '''
+    Compiles Coda source text and returns the MIDI file as bytes.
+    Safe to call repeatedly and from multiple threads: the regex and parse tables
+    are shared, and each call gets its own lexer, parser and generator.
+    If a CompileCache is given, an unchanged source is returned from it directly.
+    A BlockCache, kept by the caller for one score that is recompiled after each
+    edit, lets unchanged note blocks skip code generation.
+    '''
+    if cache is not None:
+        key = cache.key(text.encode(), cache_version(tracks), tpq)
+        midi = cache.get(key)
+        if midi is not None:
+            return midi
+
+    # Lexical Analysis
+    call_lexer = lexer.copy()
+    call_lexer.tokenize_text(text)
+    midi = compile_tokens(call_lexer, tpq, blocks, backend, tracks)
+
+    if cache is not None:
+        cache.put(key, midi)
+    return midi
+
+
+def compile_file(path, use_mmap=False, tpq=480, cache=None, backend='python', tracks=False):
+    '''Compiles the Coda file at path and returns the MIDI file as bytes.'''
+    if cache is not None:
+        key = cache.file_key(path, cache_version(tracks), tpq)
+        midi = cache.get(key)
+        if midi is not None:
+            return midi
+
+    # Lexical Analysis
+    call_lexer = lexer.copy()
+    call_lexer.tokenize(path, use_mmap=use_mmap)
+    midi = compile_tokens(call_lexer, tpq, backend=backend, tracks=tracks)
+
+    if cache is not None:
+        cache.put(key, midi)
+    return midi
+
+
+def find_sources(patterns):
+    '''
+    Expands directories (searched recursively) and glob patterns into .cd files.
+    Returns (path, relative path) pairs, relative to the directory or to the
+    pattern's leading non-wildcard directories, for mirroring into an output tree.
+    '''
+    sources = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            base = pattern
+            paths = glob.glob(os.path.join(pattern, '**', '*.cd'), recursive=True)
+        else:
+            parts = pattern.split(os.sep)
+            magic = [n for n, part in enumerate(parts) if any(c in part for c in '*?[')]
+            base = os.sep.join(parts[:magic[0]] if magic else parts[:-1])
+            paths = glob.glob(pattern, recursive=True)
+        for path in sorted(paths):
+            if os.path.isfile(path):
+                sources.append((path, os.path.relpath(path, base or os.curdir)))
+    return sources
+
+
+worker_cache = None  # Per-process CompileCache for batch workers
+
+
+def init_worker(cache_dir=None, cache_size=DEFAULT_MAX_BYTES):
+    '''
+    Sets up a batch worker process. The lexer and parse tables are built when this
+    module is imported, so they are loaded once per worker rather than per file.
+    '''
+    global worker_cache
+    lexer.scanner or lexer.compile()
+    if cache_dir:
+        worker_cache = CompileCache(cache_dir, cache_size)
+
+
+def compile_to(path, out_path, tpq=480, backend='python', tracks=False, use_mmap=False):
+    '''Batch job: compiles path to out_path. Returns (path, error or None, seconds).'''
+    start = time.perf_counter()
+    try:
+        midi = compile_file(path, use_mmap=use_mmap, tpq=tpq, cache=worker_cache, backend=backend, tracks=tracks)
+        os.makedirs(os.path.dirname(out_path) or os.curdir, exist_ok=True)
+        with open(out_path, 'wb') as outfile:
+            outfile.write(midi)
+        error = None
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    return path, error, time.perf_counter() - start
+
+
+def compile_batch(patterns, out_dir, workers=None, tpq=480, cache_dir=None, cache_size=DEFAULT_MAX_BYTES,
+                  backend='python', tracks=False, use_mmap=False):
+    '''
+    Compiles every .cd file matched by patterns across a process pool, writing each
+    to the mirrored path under out_dir. Prints a per-file summary and returns the
+    number of failures.
+    '''
+    sources = find_sources(patterns)
+    start = time.perf_counter()
+    failures = 0
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                             initargs=(cache_dir, cache_size)) as pool:
+        jobs = [pool.submit(compile_to, path, os.path.join(out_dir, os.path.splitext(rel)[0] + '.midi'),
+                            tpq, backend, tracks, use_mmap)
+                for path, rel in sources]
+        for job in jobs:
+            path, error, seconds = job.result()
+            if error is None:
+                print(f"ok    {seconds:8.3f}s  {path}")
+            else:
+                failures += 1
+                print(f"FAIL  {seconds:8.3f}s  {path}: {error}")
+
+    elapsed = time.perf_counter() - start
+    print(f"{len(sources) - failures} compiled, {failures} failed in {elapsed:.3f}s")
+    return failures
+
+
+def main():
+    argparser = argparse.ArgumentParser()
+    inputs = argparser.add_mutually_exclusive_group(required=True)
+    inputs.add_argument('-i', '--input-file', help='Input file for MIDI conversion.')
+    inputs.add_argument('-b', '--batch', nargs='+', metavar='PATH', help='Directories or glob patterns of .cd files to compile.')
+    argparser.add_argument('-o', '--output-file', default='output', help="Output file name, '-' for stdout (output directory with --batch)")
+    argparser.add_argument('-j', '--jobs', type=int, default=None, help='Worker processes for --batch (default: CPU count), or for --tracks encoding.')
+    argparser.add_argument('--mmap', action='store_true', help='Memory-map input files instead of reading them.')
+    argparser.add_argument('--tpq', type=int, default=480, help='MIDI ticks per quarter note.')
+    argparser.add_argument('--backend', choices=BACKENDS, default='python',
+                           help="MIDI encoder; 'numpy' encodes the track in bulk and requires NumPy.")
+    argparser.add_argument('--tracks', action='store_true',
+                           help='Write a format 1 MIDI file with one track per top-level block (encoded in parallel with -j).')
+    argparser.add_argument('--cache', metavar='DIR', help='Reuse and store compiled output in this cache directory.')
+    argparser.add_argument('--cache-size', type=int, default=DEFAULT_MAX_BYTES // (1024 * 1024),
+                           metavar='MB', help='Size cap of the cache directory in megabytes.')
+
+    args = argparser.parse_args()
+    if args.backend not in AVAILABLE_BACKENDS:
+        argparser.error(f"the {args.backend} backend is not available; install NumPy to use it")
+    cache_size = args.cache_size * 1024 * 1024
+
+    if args.batch:
+        if compile_batch(args.batch, args.output_file, args.jobs, args.tpq, args.cache, cache_size,
+                         args.backend, args.tracks, args.mmap):
+            sys.exit(1)
+        return
+
+    cache = CompileCache(args.cache, cache_size) if args.cache else None
+    executor = None
+    try:
+        if cache is not None:
+            midi = compile_file(args.input_file, use_mmap=args.mmap, tpq=args.tpq, cache=cache,
+                                backend=args.backend, tracks=args.tracks)
+            write = lambda outfile: outfile.write(midi)
+        else:  # Stream the track to the output instead of building it in memory
+            file_lexer = lexer.copy()
+            file_lexer.tokenize(args.input_file, use_mmap=args.mmap)
+            if args.tracks and args.jobs and args.jobs > 1:
+                executor = ProcessPoolExecutor(max_workers=args.jobs)
+            write = code_generator(file_lexer, args.tpq, backend=args.backend,
+                                   tracks=args.tracks, executor=executor).write
+    except FileNotFoundError:
+        print(f"Invalid file path supplied: '{args.input_file}'")
+        sys.exit()
+
+    try:
+        if args.output_file == '-':  # Stdout may be in append mode, where the length can't be patched
+            midi = io.BytesIO()
+            write(midi)
+            sys.stdout.buffer.write(midi.getbuffer())
+            sys.stdout.buffer.flush()
+            return
+
+        out_path = f'{args.output_file}.midi'
+        try:
+            with open(out_path, 'wb') as outfile:
+                write(outfile)
+        except BaseException:
+            os.remove(out_path)  # Don't leave a partially written file behind
+            raise
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+import hashlib
+import os
+import tempfile
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024  # Cache size cap
+ENTRY_SUFFIX = '.midi'
+
+
+class CompileCache:
+    '''
+    Content-addressed on-disk store of compiled MIDI files
+
+    Entries are named by a hash of the source, the compiler version and the ticks
+    per quarter note. Writes go to a temporary file that is renamed into place, so
+    several processes can share one directory. Reads refresh an entry's mtime, and
+    once the directory grows past max_bytes the least recently used entries are
+    removed until it is back under 90% of the cap.
+    '''
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.size = None  # Estimated size of the directory, scanned on first put
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def hasher(version, tpq):
+        h = hashlib.sha256()
+        h.update(f"{version}\0{tpq}\0".encode())
+        return h
+
+    def key(self, source: bytes, version, tpq):
+        '''Returns the cache key for source bytes'''
+        h = self.hasher(version, tpq)
+        h.update(source)
+        return h.hexdigest()
+
+    def file_key(self, path, version, tpq):
+        '''Returns the cache key for the file at path, read in chunks'''
+        h = self.hasher(version, tpq)
+        with open(path, 'rb') as infile:
+            while chunk := infile.read(1 << 20):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ENTRY_SUFFIX)
+
+    def get(self, key):
+        '''Returns the stored MIDI bytes for key, or None on a miss'''
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as entry:
+                data = entry.read()
+            os.utime(path)  # Mark as recently used
+        except FileNotFoundError:  # Missing, or evicted by another process
+            return None
+        return data
+
+    def put(self, key, data):
+        '''Stores data under key atomically, then evicts if the cache is over its cap'''
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as entry:
+                entry.write(data)
+            os.replace(tmp, self.path(key))
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+        if self.size is None:
+            self.size = sum(size for _, size, _ in self.entries())
+        else:
+            self.size += len(data)
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def entries(self):
+        '''Returns (path, size, mtime) for every entry currently on disk'''
+        found = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(ENTRY_SUFFIX):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            found.append((path, stat.st_size, stat.st_mtime))
+        return found
+
+    def evict(self):
+        '''Removes least recently used entries until under 90% of max_bytes'''
+        entries = sorted(self.entries(), key=lambda e: e[2])
+        total = sum(size for _, size, _ in entries)
+        target = self.max_bytes * 9 // 10
+        for path, size, _ in entries:
+            if total <= target:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        self.size = total
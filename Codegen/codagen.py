@@ -1,10 +1,52 @@
+import hashlib
+
+from codair import NoteEvent, ChordEvent, GroupEvent, RestEvent, LoopSeq, expand, split
+from codalexer import kind_id
 from codaparser import TokenNodeAST
-from midi import MidiGenerator
+from midi import MidiGenerator, MultiTrackGenerator, token_pitches
+
+NOTE = kind_id('NOTE')
+CHORD = kind_id('CHORD')
+REST = kind_id('REST')
+
+
+class BlockCache:
+    '''
+    Event sequences of generated blocks, kept across compiles of one score. Blocks
+    are keyed by a hash of their subtree, the typ they inherit and tpq, so after
+    an edit only the blocks on the path from the root to the change are regenerated.
+    Entries that the latest compile did not use are dropped by prune().
+    '''
+    def __init__(self):
+        self.entries = {}
+        self.used = {}  # Entries looked up or stored since the last prune
+
+    def get(self, key):
+        seq = self.used.get(key)
+        if seq is None:
+            seq = self.entries.get(key)
+            if seq is not None:
+                self.used[key] = seq
+        return seq
+
+    def put(self, key, seq):
+        self.used[key] = seq
+
+    def prune(self):
+        self.entries = self.used
+        self.used = {}
+
 
 class CodaGenerator:
-    def __init__(self, ast_root, outname='output'):
+    def __init__(self, ast_root, outname='output', tpq=480, blocks=None, backend='python',
+                 tracks=False, executor=None):
         self.root = ast_root
         self.outname = outname
+        self.tpq = tpq  # MIDI ticks per quarter note
+        self.blocks = blocks  # Optional BlockCache shared between compiles
+        self.backend = backend  # MidiGenerator backend
+        self.tracks = tracks  # Format 1 output with a track per top-level block
+        self.executor = executor  # Optional executor encoding those tracks in parallel
         self.typstack = [1]
         self.keysig = None
         self.timesig = None
@@ -14,15 +56,80 @@ class CodaGenerator:
         self.globalrep = 1
     
     def generate(self):
-        tokens, durations = self.get_sequences()
-        gen = MidiGenerator(self.tempo, tokens, durations)
-        gen.generate(self.outname)
+        self.midi_generator().generate(self.outname)
+
+    def midi_bytes(self):
+        '''Returns the MIDI file for the AST as bytes instead of writing it'''
+        return self.midi_generator().encode()
+
+    def write(self, out):
+        '''Streams the MIDI file for the AST into the binary file out'''
+        self.midi_generator().write(out)
+
+    def midi_generator(self):
+        '''Builds the event sequence and returns the generator that encodes it'''
+        seq = self.get_sequence()
+        if not self.tracks:
+            return MidiGenerator(self.tempo, expand(seq, repeats=True), self.tpq, self.backend)
+
+        sections = [part for part in seq.parts if len(part)]  # Top-level blocks
+        return MultiTrackGenerator(self.tempo, sections, self.tpq, self.backend, self.executor)
+
+    def events(self, repeats=False):
+        '''Builds the event sequence and returns a generator of the sheet's IR events'''
+        return expand(self.get_sequence(), repeats)
+
+    def event(self, tok, dur):
+        '''Returns the Event for a NOTE, CHORD or REST token lasting dur beats'''
+        ticks = int(dur * self.tpq)
+        if tok.kind == REST:
+            return RestEvent(ticks)
+        if tok.kind == CHORD:
+            return ChordEvent(token_pitches(tok), ticks)
+        return NoteEvent(token_pitches(tok), ticks)
+
+    def group(self, seq, count):
+        '''Returns seq with its first count events merged into one GroupEvent'''
+        taken = []
+        rest = split(seq, count, taken)
+        if not taken:
+            return seq
+
+        pitches = ()
+        for event in taken:
+            pitches += event.pitches
+        ticks = taken[0].ticks  # The group lasts as long as its first note
+        group = GroupEvent(pitches, ticks) if pitches else RestEvent(ticks)
+        return LoopSeq([[group]] + rest)
     
-    def get_sequences(self):
-        '''Parses AST to generate input for MidiGenerator'''
+    def get_sequence(self):
+        '''Parses AST to generate the event sequence for expand()'''
         # 1. Step 1: Get global modifiers
         self.get_globals()
-        return self.parse_block(self.root)
+        if self.blocks is None:
+            return self.parse_block(self.root)
+
+        seq = self.parse_block(self.root, self.hash_subtree(self.root))
+        self.blocks.prune()
+        return seq
+
+    def hash_subtree(self, node):
+        '''
+        Returns (digest, children) for node: a digest of its labels and token texts, and
+        a list aligned with node.children holding each production child's own pair (None
+        for tokens). The pairs follow parse_block's recursion, so AST nodes need no
+        stable identity.
+        '''
+        h = hashlib.blake2b(node.value.encode() + b'\0', digest_size=16)
+        children = []
+        for child in node.children:
+            if isinstance(child, TokenNodeAST):
+                h.update(b't' + child.tok.text.encode() + b'\0')
+                children.append(None)
+            else:
+                children.append(self.hash_subtree(child))
+                h.update(b'n' + children[-1][0])
+        return h.digest(), children
 
     def get_globals(self):
         '''Extract global identifiers. Treat the rest of the program as one note block.'''
@@ -31,7 +138,21 @@ class CodaGenerator:
         self.timesig = [self.root.children[3].children[2], self.root.children[3].children[4]]
         self.tempo = int(self.root.children[5].children[2].tok.text)
 
-    def parse_block(self, node):
+    def parse_block(self, node, hashes=None):
+        '''
+        Parse a note block, reusing its sequence from the block cache when possible.
+        hashes is node's (digest, children) pair from hash_subtree when blocks is set.
+        '''
+        if self.blocks is not None:
+            key = (hashes[0], self.typstack[-1], self.tpq)
+            seq = self.blocks.get(key)
+            if seq is None:
+                seq = self.parse_block_uncached(node, hashes)
+                self.blocks.put(key, seq)
+            return seq
+        return self.parse_block_uncached(node)
+
+    def parse_block_uncached(self, node, hashes=None):
         '''Parse a note block'''
         # typ[n] -> All notes have specified duration
         # rep[n] -> Entire block repeated as specified
@@ -43,14 +164,15 @@ class CodaGenerator:
         grp = 0
         gcount = 0  # Number of elements counted for the group
 
-        note_seq, dur_seq = [], []
+        run = []  # Events of the current run between nested blocks
+        parts = [run]
 
         # print("NODE: ", node, node.children)
         # print(f"CURRENT MODS | typ: {self.typstack[-1]} | rep: {rep} | grp: {grp}")
-        for child in node.children:
+        for i, child in enumerate(node.children):
             # print(f"\tChecking: {child}")
             if isinstance(child, TokenNodeAST):
-                if child.tok.token_class != 'CHORD' and child.tok.token_class != 'NOTE':
+                if child.tok.kind != CHORD and child.tok.kind != NOTE:
                     continue
             
             if child.value != 'NOTE BLOCK':
@@ -63,21 +185,19 @@ class CodaGenerator:
                     grp = int(child.children[2].tok.text)  # Next note block should be grouped
                 elif child.value == 'NOTE/CHORD/REST':
                     # Use current duration modifier to add values to notes
-                    note_seq.append(child.children[0].tok)
-                    dur_seq.append(self.typstack[-1])
+                    run.append(self.event(child.children[0].tok, self.typstack[-1]))
                     if grp:
                         gcount += 1
                         # print("\tINCREMENTING")
             else:
-                ns, ds = self.parse_block(child)
-                note_seq += ns
-                dur_seq += ds
+                run = []
+                parts += [self.parse_block(child, hashes and hashes[1][i]), run]
 
-        note_seq = note_seq * rep
-        dur_seq = dur_seq * rep
+        # Repetitions stay symbolic until expand() reads the sequence
+        seq = LoopSeq(parts, rep)
         if grp:
-            note_seq.insert(0, gcount)
+            seq = self.group(seq, gcount)
 
         self.typstack.pop()
 
-        return note_seq, dur_seq
+        return seq
@@ -0,0 +1,161 @@
+from bisect import bisect_right
+
+# Event kinds, also passed to TrackChunk.add_event as (kind, pitches, ticks)
+NOTE_EVENT = 'note'
+CHORD_EVENT = 'chord'
+GROUP_EVENT = 'group'  # Several notes or chords sounding together
+REST_EVENT = 'rest'  # No pitches; delays the next event by ticks
+REPEAT_EVENT = 'repeat'  # Events up to the matching END_REPEAT_EVENT are played count times
+END_REPEAT_EVENT = 'end-repeat'
+
+
+class Event:
+    '''Pitches (MIDI note numbers) that start together and last for ticks'''
+    __slots__ = ('pitches', 'ticks')
+    kind = None
+    repeat_marker = False
+
+    def __init__(self, pitches, ticks):
+        self.pitches = pitches  # Tuple of ints
+        self.ticks = ticks
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.pitches}, {self.ticks})"
+
+
+class NoteEvent(Event):
+    __slots__ = ()
+    kind = NOTE_EVENT
+
+
+class ChordEvent(Event):
+    __slots__ = ()
+    kind = CHORD_EVENT
+
+
+class GroupEvent(Event):
+    '''The first notes and chords of a grp[n] block, sounding together'''
+    __slots__ = ()
+    kind = GROUP_EVENT
+
+
+class RestEvent(Event):
+    __slots__ = ()
+    kind = REST_EVENT
+
+    def __init__(self, ticks):
+        super().__init__((), ticks)
+
+
+class RepeatEvent:
+    '''Starts a section, ended by END_REPEAT, that is played count times'''
+    __slots__ = ('count',)
+    kind = REPEAT_EVENT
+    repeat_marker = True
+
+    def __init__(self, count):
+        self.count = count
+
+
+class EndRepeatEvent:
+    __slots__ = ()
+    kind = END_REPEAT_EVENT
+    repeat_marker = True
+
+
+END_REPEAT = EndRepeatEvent()
+
+
+class LoopSeq:
+    '''
+    Read-only sequence formed by concatenating parts (lists or other LoopSeqs) and
+    repeating the result count times. Items are produced while iterating or looked
+    up by index, so memory follows the source rather than the performed length.
+    '''
+    __slots__ = ('parts', 'ends', 'count', 'period')
+
+    def __init__(self, parts, count=1):
+        self.parts = parts
+        self.ends = []  # Index just past each part within one repetition
+        total = 0
+        for part in parts:
+            total += len(part)
+            self.ends.append(total)
+        self.count = count
+        self.period = total
+
+    def __len__(self):
+        return self.period * self.count
+
+    def __iter__(self):
+        for _ in range(self.count):
+            for part in self.parts:
+                yield from part
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('LoopSeq index out of range')
+        i %= self.period
+        n = bisect_right(self.ends, i)
+        return self.parts[n][i - self.ends[n-1] if n else i]
+
+
+def expand(seq, repeats=False):
+    '''
+    Yields the Events of seq (a LoopSeq or a list of events and parts), expanding
+    repetitions as they are read. With repeats set, a repeated block is yielded
+    only once, between a RepeatEvent and END_REPEAT.
+    '''
+    if isinstance(seq, LoopSeq):
+        if repeats and seq.count > 1:
+            yield RepeatEvent(seq.count)
+            yield from expand(seq.parts, repeats)
+            yield END_REPEAT
+        else:
+            for _ in range(seq.count):
+                yield from expand(seq.parts, repeats)
+        return
+
+    for item in seq:
+        if isinstance(item, Event):
+            yield item
+        else:
+            yield from expand(item, repeats)
+
+
+def duration(seq):
+    '''Returns the total ticks of seq's events, repetitions included'''
+    if isinstance(seq, LoopSeq):
+        return seq.count * sum(duration(part) for part in seq.parts)
+    return sum(item.ticks if isinstance(item, Event) else duration(item) for item in seq)
+
+
+def split(seq, count, taken):
+    '''
+    Moves the first count events of seq (a list or LoopSeq, possibly nested) into
+    taken, expanding repetitions only as far as needed. Returns the parts that
+    play after them.
+    '''
+    if isinstance(seq, LoopSeq):
+        for done in range(seq.count):
+            if len(taken) == count:
+                return [LoopSeq(seq.parts, seq.count - done)]
+            rest = split(seq.parts, count, taken)
+            if len(taken) == count:
+                return rest + [LoopSeq(seq.parts, seq.count - done - 1)]
+        return []
+
+    for n, item in enumerate(seq):
+        if len(taken) == count:
+            return [seq[n:]]
+        if isinstance(item, Event):
+            taken.append(item)
+        else:
+            rest = split(item, count, taken)
+            if len(taken) == count:
+                return rest + [seq[n+1:]]
+    return []
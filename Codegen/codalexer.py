@@ -1,3 +1,33 @@
+from array import array
+from bisect import bisect_left
+from functools import lru_cache
+import mmap
+import os
+import threading
+
+CHUNK_SIZE = 1 << 16  # Characters read at a time by Lexer.iter_tokens
+WHITESPACE_BYTES = (ord(' '), ord('\n'), ord('\r'))  # Skipped between tokens of mapped input
+
+TEXT_KINDS = ('KEYWORD', 'CONNECTOR')  # Token classes whose text also selects the kind
+KINDS = {}  # (token class, text or None) -> kind id
+KIND_CLASSES = []  # Kind id -> token class
+RESOLVERS = {}  # Kind id -> function resolving a token's text to its value (see Regex)
+kinds_lock = threading.Lock()
+
+
+def kind_id(token_class, text=None):
+    '''Returns the small integer interned for a token class (and its text, for TEXT_KINDS)'''
+    key = (token_class, text if token_class in TEXT_KINDS else None)
+    kind = KINDS.get(key)
+    if kind is None:
+        with kinds_lock:
+            kind = KINDS.get(key)
+            if kind is None:
+                KIND_CLASSES.append(token_class)
+                kind = KINDS[key] = len(KIND_CLASSES) - 1
+    return kind
+
+
 class Token:
     '''Instance of a particular token type
     
@@ -11,22 +41,45 @@ class Token:
         Whether or not text is a valid instance of token_class
     fails: list
         Which DFA stages this token failed on, if any
+    kind: int
+        Interned kind id; tokens match when their kinds are equal
+    resolved:
+        Value of the text given by its Regex's resolve function, or None
     '''
-    def __init__(self, token_class, text, fails=[]):
+    __slots__ = ('token_class', 'text', 'kind', 'valid', 'fails', '_location', 'pos', 'lines', 'resolved')
+
+    def __init__(self, token_class, text, fails=[], kind=None):
         self.token_class = token_class
         self.text = text
+        self.kind = kind_id(token_class, text) if kind is None else kind
         self.valid = not fails
         self.fails = fails
         self.location = None
+        self.pos = None  # Offset of the token in its source
+        self.lines = None  # LineIndex used to resolve pos to a location on demand
+        resolve = RESOLVERS.get(self.kind)
+        self.resolved = resolve(text) if resolve is not None and not fails else None
+
+    @property
+    def location(self):
+        if self._location is None and self.lines is not None:
+            self._location = self.lines.coord(self.pos)
+        return self._location
+
+    @location.setter
+    def location(self, location):
+        self._location = location
     
     def equals(self, token):
-        if self.token_class not in ('KEYWORD', 'CONNECTOR'):
-            return self.token_class == token.token_class
-        else:
-            return self.token_class == token.token_class and self.text == token.text
+        return self.kind == token.kind
     
     def set_location(self, location):
         self.location = location
+
+    def set_position(self, pos, lines):
+        '''Records the token's offset; its location is only computed if asked for.'''
+        self.pos = pos
+        self.lines = lines
     
     def get_location(self):
         if not self.location:
@@ -37,10 +90,96 @@ class Token:
         return f"<{self.token_class}, VALUE='{self.text}', VALID={self.valid}>"
 
 
+def line_col(pos, count, last, prev, cr=0):
+    '''
+    Returns (line, column) for pos given the number of newlines before it and the
+    offsets of the last two of them (-1 if absent). Agrees with splitlines() on the
+    text before pos: a position just past a newline reports the end of that line,
+    whose length excludes the carriage return (cr=1) of a CRLF ending.
+    '''
+    if pos == 0:
+        return 0, 1
+    if count and last == pos - 1:
+        return count, pos - (prev + 1) - cr
+    return count + 1, pos - last
+
+
+class LineIndex:
+    '''
+    Offsets of every newline in a source, for converting positions to (line, column).
+    The source may be a str or a bytes-like object such as an mmap, in which case
+    offsets and columns count bytes.
+    '''
+    def __init__(self, text):
+        self.text = text
+        self.newlines = None  # Built on the first lookup
+        self.crlf = bytearray()  # Per newline of a bytes source, 1 if preceded by '\r'
+
+    def build(self):
+        '''Indexes the source now, after which it is no longer referenced.'''
+        text = self.text
+        is_bytes = not isinstance(text, str)
+        nl = b'\n' if is_bytes else '\n'
+        self.newlines = array('q')
+        i = text.find(nl)
+        while i != -1:
+            self.newlines.append(i)
+            if is_bytes:
+                self.crlf.append(i > 0 and text[i-1] == ord('\r'))
+            i = text.find(nl, i + 1)
+        self.text = None
+
+    def advance(self, text, base, pos):
+        '''The whole text is indexed on demand, so there is nothing to count.'''
+        pass
+
+    def coord(self, pos):
+        '''Returns (line, column) for pos'''
+        if self.newlines is None:
+            self.build()
+
+        newlines = self.newlines
+        k = bisect_left(newlines, pos)  # Newlines before pos
+        last = newlines[k-1] if k else -1
+        prev = newlines[k-2] if k > 1 else -1
+        cr = self.crlf[k-1] if k and self.crlf else 0
+        return line_col(pos, k, last, prev, cr)
+
+
+class LineCounter:
+    '''
+    Tracks (line, column) while a source is read front to back, keeping no text.
+    newline is b'\\n' for bytes-like sources.
+    '''
+    def __init__(self, newline='\n'):
+        self.newline = newline
+        self.upto = 0  # Offset counted up to
+        self.count = 0  # Newlines before upto
+        self.last = -1  # Offsets of the last two newlines before upto
+        self.prev = -1
+
+    def advance(self, text, base, pos):
+        '''Counts the newlines up to pos in text, which begins at offset base.'''
+        i = text.find(self.newline, self.upto - base, pos - base)
+        while i != -1:
+            self.count += 1
+            self.prev, self.last = self.last, base + i
+            i = text.find(self.newline, i + 1, pos - base)
+        self.upto = max(self.upto, pos)
+
+    def coord(self, pos):
+        '''Returns (line, column) for pos, which must have been advanced to.'''
+        return line_col(pos, self.count, self.last, self.prev)
+
+
 class Regex:
-    '''Custom regular expression class'''
+    '''
+    Custom regular expression class
+    If resolve is given, it is called with the text of each token of this class and
+    the result is kept as the token's resolved value. Results are cached per text.
+    '''
     def __init__(self, token_class, text_re, stage_dict, 
-                 optionals=[], repeats=[], inverts=[], single=False):
+                 optionals=[], repeats=[], inverts=[], single=False, resolve=None):
         self.textexp = text_re
         self.tclass = token_class
         self.stages = stage_dict
@@ -50,18 +189,26 @@ class Regex:
         self.final = max(set(stage_dict.keys()) - set(optionals))  # Final stage
         self.max_stage = max(stage_dict.keys())
         self.single = single
+        self.kind = kind_id(token_class)  # Kind of every match unless the class is in TEXT_KINDS
+        if resolve is not None:
+            RESOLVERS[self.kind] = lru_cache(maxsize=None)(resolve)
 
-    def search(self, input):
-        '''Search for a match in given input'''
-        return self.match(input)
+    def search(self, text, start=0):
+        '''Search for a match in text beginning at start'''
+        return self.match(text, start)
     
-    def match(self, input):
-        '''Returns Token object for a given input, None if invalid'''
+    def match(self, text, start=0):
+        '''
+        Runs the regex on text beginning at offset start without slicing it.
+        Returns (end, fails): the token's text is text[start:end] and fails lists the
+        stages that were not matched. The match is valid when fails is empty.
+        '''
         failed = []  # Failed stages
-        i = 0
+        i = start
+        n = len(text)
         stage = 0
-        while i < len(input) and stage <= self.max_stage:
-            c = input[i]
+        while i < n and stage <= self.max_stage:
+            c = text[i]
             valid_chars = self.stages[stage]
 
             if stage not in self.invs:
@@ -82,45 +229,464 @@ class Regex:
                 failed.append(stage)
                 stage += 1
         
-        # Check that final stage was reached
-        if stage - 1 >= self.final:
-            # print(self.tclass, self.failed, input[:i].strip('\n'))
-            return Token(self.tclass, input[:i].strip('\n'), fails=failed)
-        # print(f"Minimum final stage not reached. Current stage: {stage}")
-        return Token(self.tclass, input[:i].strip('\n'), fails=failed)
+        # Trailing newlines (comment terminators) are not part of the token
+        while i > start and text[i-1] == '\n':
+            i -= 1
+        return i, failed
+
+    def kind_at(self, text, start, end):
+        '''Returns the kind id of the match text[start:end]'''
+        if self.tclass in TEXT_KINDS:
+            match = text[start:end]
+            return kind_id(self.tclass, match if isinstance(match, str) else match.decode())
+        return self.kind
+
+    def token(self, text, start, end):
+        '''Creates the Token for a match found by match()'''
+        token_text = text[start:end]
+        if self.tclass in TEXT_KINDS:
+            return Token(self.tclass, token_text)
+        return Token(self.tclass, token_text, kind=self.kind)
     
     def __repr__(self):
         return f"<REGEX, TEXTEXP={self.textexp}, STAGEDICT={self.stages}>"
 
 
+class TokenTable:
+    '''
+    Columnar token store over a source text. Kind ids (see kind_id), start/end offsets and line
+    numbers are kept in parallel arrays, and a Token is only created when an entry
+    is accessed. Supports the list operations the parser uses. The source may also be
+    UTF-8 bytes such as an mmap, which must stay open while the table is used; token
+    text is then decoded on access.
+    '''
+    def __init__(self, source, index=None):
+        self.source = source
+        self.index = index or LineIndex(source)  # Resolves columns on demand
+        self.kinds = array('H')
+        self.starts = array('q')
+        self.ends = array('q')
+        self.lines = array('I')
+        self.texts = {}  # Entry -> text, for tokens whose text is not in the source (e.g. EOF)
+        self.counter = LineCounter('\n' if isinstance(source, str) else b'\n')
+        self.cached = None  # Last (entry, Token) handed out
+
+    def add(self, kind, start, end, text=None):
+        '''Adds the token spanning source[start:end], or with the given text if it is not there.'''
+        self.counter.advance(self.source, 0, start)
+        self.kinds.append(kind)
+        self.starts.append(start)
+        self.ends.append(end)
+        self.lines.append(self.counter.coord(start)[0])
+        if text is not None:
+            self.texts[len(self.kinds) - 1] = text
+
+    def append(self, token):
+        '''Adds a Token object, e.g. the parser's EOF marker.'''
+        start = token.pos if token.pos is not None else len(self.source)
+        end = start + len(token.text)
+        text = None if self.source[start:end] == token.text else token.text
+        self.add(token.kind, start, end, text)
+
+    def kind(self, i):
+        return self.kinds[i]
+
+    def text(self, i):
+        '''Materializes the text of entry i'''
+        if i in self.texts:
+            return self.texts[i]
+        text = self.source[self.starts[i]:self.ends[i]]
+        return text if isinstance(text, str) else text.decode()
+
+    def line(self, i):
+        return self.lines[i]
+
+    def without(self, token_class):
+        '''Returns a table sharing this source with every token of token_class removed'''
+        table = TokenTable(self.source, self.index)
+        for i in range(len(self.kinds)):
+            if KIND_CLASSES[self.kinds[i]] != token_class:
+                table.kinds.append(self.kinds[i])
+                table.starts.append(self.starts[i])
+                table.ends.append(self.ends[i])
+                table.lines.append(self.lines[i])
+                if i in self.texts:
+                    table.texts[len(table.kinds) - 1] = self.texts[i]
+        table.counter = self.counter
+        return table
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self.kinds)
+        if self.cached and self.cached[0] == i:
+            return self.cached[1]
+        if not 0 <= i < len(self.kinds):
+            raise IndexError("token table index out of range")
+
+        kind = self.kinds[i]
+        token = Token(KIND_CLASSES[kind], self.text(i), kind=kind)
+        token.set_position(self.starts[i], self.index)
+        self.cached = (i, token)
+        return token
+
+    def __iter__(self):
+        for i in range(len(self.kinds)):
+            yield self[i]
+
+
+class PartialScan:
+    '''Where a scan() stopped at the end of its text: the DFA state, the best match so far and the next position'''
+    __slots__ = ('state', 'best', 'pos')
+
+    def __init__(self, state, best, pos):
+        self.state = state
+        self.best = best
+        self.pos = pos
+
+    def shift(self, offset):
+        '''Moves the scan back by offset characters, for text that dropped them from its front'''
+        self.pos -= offset
+        if self.best is not None:
+            self.best = (self.best[0], self.best[1] - offset)
+
+
+class Scanner:
+    '''Combined DFA built from every registered Regex
+
+    States are sets of (regex index, stage) pairs reached by running all regexes
+    over the input in lockstep. A regex leaves the set as soon as a required stage
+    fails, so only matches that would come back valid are tracked. Characters that
+    no stage dictionary mentions all behave the same way and share one column.
+    '''
+
+    def __init__(self, regexes):
+        self.regexes = regexes
+        self.alphabet = set()
+        for regex in regexes:
+            for chars in regex.stages.values():
+                self.alphabet.update(chars)
+
+        self.trans = []  # state id -> {char: (next state id, accepted regex index)}
+        self.byte_trans = None  # state id -> cells indexed by byte value, for bytes input
+        self.other = []  # state id -> (next state id, accepted regex index)
+        self.eof_accept = []  # state id -> regex index accepted at end of input
+        self.live = []  # state id -> indices of the regexes still matching
+        self.until = []  # state id -> the one character leaving a state that loops on all others, else None
+        self.build()
+
+    def build(self):
+        '''Subset construction over the registered regexes.'''
+        start = frozenset((r, 0) for r in range(len(self.regexes)))
+        ids = {start: 0}
+        states = [start]
+        while len(self.trans) < len(states):
+            state = states[len(self.trans)]
+            row = {}
+            for c in list(self.alphabet) + [None]:
+                nxt, accept = self.step(state, c)
+                if nxt:
+                    if nxt not in ids:
+                        ids[nxt] = len(states)
+                        states.append(nxt)
+                    cell = (ids[nxt], accept)
+                else:
+                    cell = (None, accept)
+                if c is None:
+                    self.other.append(cell)
+                else:
+                    row[c] = cell
+            self.trans.append(row)
+            self.eof_accept.append(max((r for r, _ in state), default=None))
+            self.live.append(frozenset(r for r, _ in state))
+
+        for sid, row in enumerate(self.trans):
+            exits = [c for c, (nxt, _) in row.items() if nxt != sid]
+            self.until.append(exits[0] if len(exits) == 1 and self.other[sid][0] == sid else None)
+
+    def step(self, state, c):
+        '''
+        Advances every (regex, stage) pair in state over character c (None for any
+        character outside the alphabet). Returns the next state and the latest
+        registered regex that finished just before c, if any.
+        '''
+        nxt = set()
+        finished = []
+        for r, stage in state:
+            regex = self.regexes[r]
+            while True:
+                if stage > regex.max_stage:  # Regex is complete, match ends before c
+                    finished.append(r)
+                    break
+                valid = c is not None and c in regex.stages[stage]
+                if stage in regex.invs:
+                    valid = not valid
+
+                if stage not in regex.opts and stage not in regex.reps:
+                    if valid:
+                        nxt.add((r, stage + 1))
+                    break  # Required stage failed; match can no longer be valid
+                elif stage in regex.opts:
+                    if valid:
+                        nxt.add((r, stage + 1))
+                        break
+                    stage += 1
+                else:  # Repeated stage
+                    if valid:
+                        nxt.add((r, stage))
+                        break
+                    stage += 1
+        return frozenset(nxt), max(finished, default=None)
+
+    def scan(self, text, pos, final=True, partial=None):
+        '''
+        Returns (regex index, end position) of the longest valid match starting at
+        pos, or None if no regex matches. Ties go to the latest registered regex.
+        If final is False, text is only a prefix of the input and a PartialScan is
+        returned when the walk reaches its end. Passing it back as partial once more
+        text has been appended continues the walk where it stopped.
+        '''
+        trans, other = self.trans, self.other
+        state = 0
+        best = None
+        if partial is not None:
+            state, best, pos = partial.state, partial.best, partial.pos
+        end = len(text)
+        while pos < end:
+            nxt, accept = trans[state].get(text[pos]) or other[state]
+            if accept is not None:
+                best = (accept, pos)
+            if nxt is None:
+                return best
+            state = nxt
+            pos += 1
+
+        if not final:
+            return PartialScan(state, best, pos)
+        accept = self.eof_accept[state]
+        if accept is not None:
+            best = (accept, pos)
+        return best
+
+
+    def scan_bytes(self, data, pos):
+        '''
+        scan() over bytes-like data such as an mmap. Stage characters are ASCII, so
+        every byte of a multi-byte UTF-8 sequence takes the shared "other" column.
+        '''
+        if self.byte_trans is None:
+            self.byte_trans = [[row.get(chr(b)) or other if b < 128 else other for b in range(256)]
+                               for row, other in zip(self.trans, self.other)]
+        trans = self.byte_trans
+        state = 0
+        best = None
+        end = len(data)
+        while pos < end:
+            nxt, accept = trans[state][data[pos]]
+            if accept is not None:
+                best = (accept, pos)
+            if nxt is None:
+                return best
+            state = nxt
+            pos += 1
+
+        accept = self.eof_accept[state]
+        if accept is not None:
+            best = (accept, pos)
+        return best
+
+
 class Lexer:
-    def __init__(self):
+    def __init__(self, compiled=True, columnar=False):
         self.position = 0
         self.tokens = []  # Matched tokens
         self.token_bank = []  # Valid regexes
         self.singles = []  # Single-character tokens
         self.input = ""
+        self.base = 0  # Offset of self.input in the source when streaming
+        self.partial = None  # PartialScan of a streamed token that continues past self.input
+        self.lines = LineIndex("")
+        self.compiled = compiled  # Use the combined scanner instead of running each regex
+        self.columnar = columnar  # Store tokens of text input in a TokenTable (mapped input always is)
+        self.scanner = None
 
     def register_token(self, regex):
         '''Adds a recognized token type.'''
         self.token_bank.append(regex)
         if regex.single:
             self.singles.append(regex.tclass)
+        self.scanner = None  # Stale once the token bank changes
+
+    def compile(self):
+        '''Merges all registered regexes into a single combined scanner.'''
+        self.scanner = Scanner(self.token_bank)
+        return self.scanner
+
+    def copy(self):
+        '''
+        Returns a fresh Lexer sharing this one's registered regexes and compiled scanner,
+        which are not modified by lexing. Use one copy per input or thread.
+        '''
+        lexer = Lexer(self.compiled, self.columnar)
+        lexer.token_bank = self.token_bank
+        lexer.singles = self.singles
+        lexer.scanner = self.scanner or self.compile()
+        return lexer
+
+    def reset(self, text=""):
+        '''Clears the state left by a previous input.'''
+        self.input = text
+        self.position = 0
+        self.base = 0
+        self.partial = None
+        self.lines = LineIndex(text)
+        self.tokens = TokenTable(text, self.lines) if self.columnar else []
+
+    def tokenize(self, input_path, use_mmap=False):
+        '''
+        Tokenizes the entire input string. With use_mmap, the file is scanned as
+        mapped bytes instead of being read into memory (see tokenize_mapped).
+        '''
+        if use_mmap:
+            return self.tokenize_mapped(input_path)
 
-    def tokenize(self, input_path):
-        '''Tokenizes the entire input string.'''
         with open(input_path, 'r') as infile:
-            self.input = infile.read()
+            self.tokenize_text(infile.read())
+
+    def tokenize_text(self, text):
+        '''Tokenizes a source string. Line endings are normalized as when reading a file.'''
+        if '\r' in text:
+            text = text.replace('\r\n', '\n').replace('\r', '\n')
+        self.reset(text)
         
         self.skip_whitespace()
         while self.position < len(self.input):
             self.exec_dfa()
             self.skip_whitespace()
 
+    def tokenize_mapped(self, input_path):
+        '''
+        Tokenizes a UTF-8 file through a read-only memory map into a TokenTable of
+        offsets over the mapped bytes. The map stays open while the table refers to
+        it, and token text is only decoded when an entry is accessed; token offsets
+        and columns count bytes. CRLF line endings are accepted as in text mode.
+        '''
+        scanner = self.scanner or self.compile()
+        self.reset()
+        with open(input_path, 'rb') as infile:
+            if os.fstat(infile.fileno()).st_size == 0:
+                return
+            data = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)  # Outlives the file object
+        self.lines = LineIndex(data)
+        self.tokens = TokenTable(data, self.lines)
+
+        pos = 0
+        n = len(data)
+        while True:
+            while pos < n and data[pos] in WHITESPACE_BYTES:
+                pos += 1
+            if pos == n:
+                break
+
+            found = scanner.scan_bytes(data, pos)
+            if found is None:
+                self.mapped_error(data, pos)
+            index, end = found
+            while end > pos and data[end-1] in WHITESPACE_BYTES[1:]:
+                end -= 1
+
+            self.tokens.add(self.token_bank[index].kind_at(data, pos, end), pos, end)
+            pos = end
+
+    def mapped_error(self, data, pos):
+        '''Reports a lexical error in mapped input exactly as tokenize() would.'''
+        def translate(raw):
+            return raw.decode().replace('\r\n', '\n').replace('\r', '\n')
+
+        self.reset(translate(data[:]))
+        self.position = len(translate(data[:pos]))
+        self.lex_error([(regex,) + regex.search(self.input, self.position) for regex in self.token_bank])
+
+    def iter_tokens(self, fileobj, with_comments=False, chunk_size=CHUNK_SIZE):
+        '''
+        Lexes a text file object incrementally, yielding each Token once it is complete.
+        Input is read chunk_size characters at a time and only the unconsumed part is
+        kept, so tokens and comments may span chunks. A token that spans chunks is
+        scanned once, resuming where the last chunk ended, and unless with_comments
+        is set a comment's text is skipped without being kept. Tokens are not kept
+        in self.tokens.
+        '''
+        self.reset()
+        self.lines = LineCounter()
+        final = False
+        while True:
+            self.skip_whitespace()
+            if self.position == len(self.input):
+                if final:
+                    return
+                final = not self.read_chunk(fileobj, chunk_size)
+                continue
+
+            match = self.scan_token(final)
+            if match is None:  # Need more input to decide
+                if not with_comments and self.in_comment():
+                    self.skip_comment(fileobj, chunk_size)
+                else:
+                    final = not self.read_chunk(fileobj, chunk_size)
+                continue
+
+            match.set_position(self.base + self.position, None)
+            match.set_location(self.pos_to_coord(self.position))
+            self.position += len(match.text)
+            if with_comments or match.token_class != "COMMENT":
+                yield match
+
+    def read_chunk(self, fileobj, size):
+        '''
+        Drops consumed input and appends the next chunk. Returns False at end of file.
+        While a token is pending, at least as much as it already holds is read, so a
+        long token is only copied a logarithmic number of times.
+        '''
+        self.lines.advance(self.input, self.base, self.base + self.position)
+        chunk = fileobj.read(max(size, len(self.input) - self.position))
+        if self.partial is not None:
+            self.partial.shift(self.position)
+        self.base += self.position
+        self.input = self.input[self.position:] + chunk
+        self.position = 0
+        return bool(chunk)
+
+    def in_comment(self):
+        '''Whether the pending scan is in the body of a COMMENT, which only a newline ends'''
+        if self.partial is None or self.scanner.until[self.partial.state] != '\n':
+            return False
+        live = set(self.scanner.live[self.partial.state])
+        if self.partial.best is not None:
+            live.add(self.partial.best[0])
+        return all(self.token_bank[r].tclass == "COMMENT" for r in live)
+
+    def skip_comment(self, fileobj, size):
+        '''
+        Moves past the comment at the current position to the newline ending it, or to
+        the end of input, reading as far as needed without keeping the comment's text.
+        '''
+        self.partial = None
+        end = self.input.find('\n', self.position)
+        while end == -1:
+            self.position = len(self.input)
+            if not self.read_chunk(fileobj, size):
+                return
+            end = self.input.find('\n')
+        self.position = end
+
     def get_tokens(self, with_comments=False):
-        '''Returns list of tokens after lexing.'''
+        '''Returns list of tokens after lexing (a TokenTable in columnar mode or for mapped input).'''
         if with_comments:
             return self.tokens
+        if isinstance(self.tokens, TokenTable):
+            return self.tokens.without("COMMENT")
         return [t for t in self.tokens if t.token_class != "COMMENT"]
 
     def skip_whitespace(self):
@@ -135,51 +701,92 @@ class Lexer:
         Appends new token to the token list.
         Raises an exception on lexical error.
         '''
-        matches = []
+        if not self.compiled:
+            return self.exec_regexes()
+
+        regex, end = self.scan_match()
+        self.emit(regex, end)
+
+    def emit(self, regex, end):
+        '''Records the match of regex from the current position to end and moves past it.'''
+        if isinstance(self.tokens, TokenTable):
+            self.tokens.add(regex.kind_at(self.input, self.position, end), self.position, end)
+        else:
+            match = regex.token(self.input, self.position, end)
+            match.set_position(self.position, self.lines)
+            self.tokens.append(match)
+        self.position = end
+
+    def scan_token(self, final=True):
+        '''
+        Returns the longest valid Token at the current position without consuming it.
+        If final is False, input may continue past self.input and None is returned
+        when more of it is needed. Raises an exception on lexical error.
+        '''
+        found = self.scan_match(final)
+        if found is None:
+            return None
+        regex, end = found
+        return regex.token(self.input, self.position, end)
+
+    def scan_match(self, final=True):
+        '''As scan_token, but returns the matching (regex, end) without creating a Token.'''
+        scanner = self.scanner or self.compile()
+        found = scanner.scan(self.input, self.position, final, self.partial)
+        self.partial = None
+        if isinstance(found, PartialScan):
+            self.partial = found
+            return None
+        if found is None:
+            attempts = [(regex,) + regex.search(self.input, self.position) for regex in self.token_bank]
+            if not final and (len(self.input) - self.position < 12 or
+                              any(end == len(self.input) for _, end, _ in attempts)):
+                return None  # Report the error against the same input tokenize() would see
+            self.lex_error(attempts)
+
+        index, end = found
+        while end > self.position and self.input[end-1] == '\n':
+            end -= 1
+        return self.token_bank[index], end
+
+    def exec_regexes(self):
+        '''Runs every registered regex separately at the current position.'''
+        attempts = []  # (regex, end, fails)
         for regex in self.token_bank:
-            matches.append(regex.search(self.input[self.position:]))
+            attempts.append((regex,) + regex.search(self.input, self.position))
         
-        valids = [m for m in matches if m.valid]
+        valids = [a for a in attempts if not a[2]]
         if not valids:
-            if self.position+10 < len(self.input) - 1:
-                inp_slice = "'" + self.input[self.position:self.position+10] + '...' + "'"
-            else:
-                inp_slice = self.input[self.position:]
-            line, col = self.pos_to_coord(self.position)
-
-            # Correction suggestion: If exactly one character failed, suggest a correction.
-            # If exactly one character failed for multiple possible tokens, choose the longest.
-            # Exclude tokens that can be single characters.
-            almost = [m for m in matches if len(m.fails) == 1 and m.token_class not in self.singles]
-            if almost:
-                failures = [len(m.text) for m in almost]
-                zipped = zip(almost, failures)
-                csugg = sorted(zipped, key=lambda x: x[1])[-1][0]
-
-                # print(f"{len(almost)} single-stage failures found.")
-                raise LexerException(f"Malformed token found. For {csugg.token_class} token, correct stage {csugg.fails[0]} of input on line {line}, column {col}: {inp_slice}")
-            else:
-                raise LexerException(f"Unrecognized symbol or token on line {line}, column {col}: {inp_slice}")
+            self.lex_error(attempts)
         
-        # Maximal munch
-        matchlens = [len(m.text) for m in valids]
-        zipped = zip(valids, matchlens)
-        match = sorted(zipped, key=lambda x: x[1])[-1][0]
+        # Maximal munch; ties go to the latest registered regex
+        regex, end, _ = sorted(valids, key=lambda a: a[1])[-1]
+        self.emit(regex, end)
 
+    def lex_error(self, attempts):
+        '''Raises a LexerException for the current position given every regex's (regex, end, fails).'''
+        if self.position+10 < len(self.input) - 1:
+            inp_slice = "'" + self.input[self.position:self.position+10] + '...' + "'"
+        else:
+            inp_slice = self.input[self.position:]
         line, col = self.pos_to_coord(self.position)
-        match.set_location((line, col))
-        self.tokens.append(match)
-        self.position += len(match.text)
-        # print(match, len(match.text))
-        return
+
+        # Correction suggestion: If exactly one character failed, suggest a correction.
+        # If exactly one character failed for multiple possible tokens, choose the longest.
+        # Exclude tokens that can be single characters.
+        almost = [a for a in attempts if len(a[2]) == 1 and a[0].tclass not in self.singles]
+        if almost:
+            regex, _, fails = sorted(almost, key=lambda a: a[1])[-1]
+
+            # print(f"{len(almost)} single-stage failures found.")
+            raise LexerException(f"Malformed token found. For {regex.tclass} token, correct stage {fails[0]} of input on line {line}, column {col}: {inp_slice}")
+        else:
+            raise LexerException(f"Unrecognized symbol or token on line {line}, column {col}: {inp_slice}")
 
     def pos_to_coord(self, pos):
         '''Convert position in input to line number, column number'''
-        lines = self.input[:pos].splitlines()
-        line_num = len(lines)
-        col_num = len(lines[-1]) + 1 if lines else 1
-
-        return line_num, col_num
+        self.lines.advance(self.input, self.base, self.base + pos)
+        return self.lines.coord(self.base + pos)
 
     def __exit__(self):
         '''Ensures the input file is closed.'''
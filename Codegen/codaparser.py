@@ -1,5 +1,6 @@
-from codalexer import Token
-from typing import List
+from array import array
+from codalexer import Token, TokenTable
+from typing import List, Union
 
 symbol_map = {  # Maps production names to descriptions
     '!' : 'GLOBAL FLAG',
@@ -13,95 +14,221 @@ symbol_map = {  # Maps production names to descriptions
     'W': 'NOTE/CHORD/REST'
 }
 
+# StreamParser event types
+ENTER_BLOCK = 'enter-block'
+MODIFIER = 'modifier'
+NOTE = 'note'
+EXIT_BLOCK = 'exit-block'
+
 class Parser:
-    def __init__(self, input: List[Token], parse_table, start_sym):
+    def __init__(self, input: Union[List[Token], TokenTable], parse_table, start_sym):
         self.pos = 0  # Position in list of input tokens
         self.input = input
         input.append(Token('EOF', '$'))
-        self.fderived = []
-        self.derived = (start_sym,)  # Derived string, list of Tokens and strings (productions)
-        self.ptab = parse_table
+        self.init_driver(parse_table, start_sym)
         
         # AST
-        self.nodables = parse_table.get_nodables()
         self.root = ProductionNodeAST("CODA SHEET")
         self.nodestack = [self.root]
+
+    def init_driver(self, parse_table, start_sym):
+        '''Sets up the LL(1) stack for deriving start_sym.'''
+        self.last = None  # Grammar symbol of the last matched token, for error messages
+        self.stack = [start_sym]  # Symbols left to derive, top of stack last
+        self.pending = 1  # Productions (non-Token symbols) on the stack
+        self.ptab = parse_table
+        self.nodables = parse_table.get_nodables()
         self.closestack = []  # To end a currently open
     
     def parse(self, print_result=False):
-        while False in [isinstance(n, Token) for n in self.derived]:
+        '''Runs the LL(1) driver until no productions are left to expand, then expects EOF.'''
+        while self.pending:
             self.advance()
+        self.expect_eof()
         if print_result:
             print_ast(self.root)
 
     def advance(self):
         # self.print_derived()
-        cur_tok = self.input[self.pos]  # Token object
-        cur_sym = self.derived[0]  # Token or string
+        cur_tok = self.lookahead()  # Token object
+        cur_sym = self.stack.pop()  # Token or string
         if not isinstance(cur_sym, Token):  # is a production
+            self.pending -= 1
             if cur_sym == '_':
-                self.derived = self.derived[1:]
                 return
             
             # print(f"Expanding '{cur_sym}'; Looking at '{cur_tok}'")
             expanded = self.ptab.get_production(cur_sym, cur_tok)
             if not expanded:
-                raise ParserException(f"SyntaxError: Token {cur_tok} on line {cur_tok.location[0]}, column {cur_tok.location[1]} cannot follow token {self.fderived[-1]}.")
+                if self.last is None:
+                    raise ParserException(f"SyntaxError: Token {cur_tok} on line {cur_tok.location[0]}, column {cur_tok.location[1]} cannot begin a Coda sheet.")
+                raise ParserException(f"SyntaxError: Token {cur_tok} on line {cur_tok.location[0]}, column {cur_tok.location[1]} cannot follow token {self.last}.")
             # print(f"Expanded to {expanded}")
-            self.derived = expanded + self.derived[1:]  # Should be list of tokens and strings
+            self.stack.extend(reversed(expanded))  # Leftmost symbol ends up on top
+            for sym in expanded:
+                if not isinstance(sym, Token):
+                    self.pending += 1
 
             # Check if chosen production is nodable
             if expanded in self.nodables:
                 # print("Nodable found:", expanded)
                 # print("Closing symbol:", expanded[-1])
-                node = ProductionNodeAST(symbol_map[cur_sym])
-                self.nodestack[-1].add_child(node)
-                closesym = expanded[-1]
-                self.closestack.append(closesym)
-                self.nodestack.append(node)
+                self.open_node(symbol_map[cur_sym], expanded[-1])
 
         else:  # Match token
             # print(f"Attempting to match {str(cur_tok)}")
             if cur_tok.equals(cur_sym):
-                self.fderived.append(self.derived[0])
-                self.derived = self.derived[1:]
-                self.pos += 1
+                self.last = cur_sym
+                self.consume()
                 # print("Matched successfully.")
-
-                # Add as child on current node; close if necessary
-                node = TokenNodeAST(cur_tok)
-                self.nodestack[-1].add_child(node)
-                
-                if self.closestack and cur_tok.equals(self.closestack[-1]):
-                    # print("Closing symbol found")
-                    # print("CHILDREN AT CLOSING:", self.nodestack[-1].children)
-                    # print(self.root.children)
-                    self.nodestack.pop()
-                    self.closestack.pop()
+                self.add_token(cur_tok)
             else:
                 raise ParserException(f"SyntaxError at line {cur_tok.location[0]}, column {cur_tok.location[1]}. Expected instance of {cur_sym.token_class}, found {cur_tok.token_class}.")
 
+    def expect_eof(self):
+        '''Raises a ParserException if input is left once the sheet has been derived.'''
+        cur_tok = self.lookahead()
+        if cur_tok.token_class != 'EOF':
+            raise ParserException(f"SyntaxError: Token {cur_tok} on line {cur_tok.location[0]}, column {cur_tok.location[1]} follows the end of the Coda sheet.")
+
+    def lookahead(self):
+        '''Returns the current input token.'''
+        return self.input[self.pos]
+
+    def consume(self):
+        '''Moves past the current input token.'''
+        self.pos += 1
+
+    def open_node(self, label, closesym):
+        '''Starts an AST node for a nodable production ending in closesym.'''
+        node = ProductionNodeAST(label)
+        self.nodestack[-1].add_child(node)
+        self.closestack.append(closesym)
+        self.nodestack.append(node)
+
+    def add_token(self, token):
+        '''Adds a matched token to the current node, closing the node if necessary.'''
+        node = TokenNodeAST(token)
+        self.nodestack[-1].add_child(node)
+        
+        if self.closestack and token.equals(self.closestack[-1]):
+            # print("Closing symbol found")
+            self.close_node()
+
+    def close_node(self):
+        self.nodestack.pop()
+        self.closestack.pop()
+
     def print_derived(self):
-        s = ""
-        for val in self.fderived:
-            s += val if not isinstance(val, Token) else val.text
-        if s:
-            print(f"TD: {s}")
+        if self.last is not None:
+            print(f"LAST: {self.last.text}")
 
         s = ""
-        for val in self.derived:
+        for val in reversed(self.stack):
             s += val if not isinstance(val, Token) else val.text
         print(f"OD: {s}")
 
 
+class StreamParser(Parser):
+    '''
+    Parses tokens pulled one at a time from an iterator (e.g. Lexer.iter_tokens) and
+    reports the sheet as SAX-style events instead of building an AST:
+
+        (ENTER_BLOCK, None)              a NOTE BLOCK opens
+        (MODIFIER, (label, values))      a modifier closed; values are its bracketed tokens
+        (NOTE, token)                    a NOTE, CHORD or REST
+        (EXIT_BLOCK, None)               the innermost open NOTE BLOCK closes
+
+    Global modifiers are reported as MODIFIER events outside any block. Only the
+    parse stack and the open nodes are kept in memory.
+    '''
+    def __init__(self, tokens, parse_table, start_sym):
+        self.tokens = iter(tokens)
+        self.ahead = None  # Lookahead token, pulled on demand
+        self.eof = Token('EOF', '$')
+        self.nodestack = []  # [label, tokens] for each open node
+        self.queue = []  # Events produced by the current step
+        self.init_driver(parse_table, start_sym)
+
+    def events(self):
+        '''Generator over the sheet's events; raises ParserException on a syntax error.'''
+        while self.pending:
+            self.advance()
+            if self.queue:
+                yield from self.queue
+                self.queue.clear()
+        self.expect_eof()
+
+    def parse(self, print_result=False):
+        for _ in self.events():
+            pass
+
+    def lookahead(self):
+        if self.ahead is None:
+            self.ahead = next(self.tokens, self.eof)
+        return self.ahead
+
+    def consume(self):
+        self.ahead = None
+
+    def open_node(self, label, closesym):
+        self.closestack.append(closesym)
+        self.nodestack.append([label, []])
+        if label == 'NOTE BLOCK':
+            self.queue.append((ENTER_BLOCK, None))
+
+    def add_token(self, token):
+        if self.nodestack and self.nodestack[-1][0] != 'NOTE BLOCK':
+            self.nodestack[-1][1].append(token)
+        if self.closestack and token.equals(self.closestack[-1]):
+            self.close_node()
+
+    def close_node(self):
+        label, tokens = self.nodestack.pop()
+        self.closestack.pop()
+        if label == 'NOTE BLOCK':
+            self.queue.append((EXIT_BLOCK, None))
+        elif label == 'NOTE/CHORD/REST':
+            self.queue.append((NOTE, tokens[0]))
+        else:  # Modifier: keyword [ value (, value)* ]
+            self.queue.append((MODIFIER, (label, tokens[2:-1:2])))
+
+
+class ArenaParser(Parser):
+    '''Parser that stores its AST in an ArenaAST; self.root is a view of the arena's root.'''
+    def __init__(self, input: Union[List[Token], TokenTable], parse_table, start_sym):
+        super().__init__(input, parse_table, start_sym)
+        self.arena = ArenaAST(self.input, "CODA SHEET")
+        self.root = self.arena.view(0)
+        self.nodestack = [0]  # Node ids
+
+    def open_node(self, label, closesym):
+        node = self.arena.add(self.nodestack[-1], label)
+        self.closestack.append(closesym)
+        self.nodestack.append(node)
+
+    def add_token(self, token):
+        self.arena.add(self.nodestack[-1], tok=self.pos - 1)  # Already consumed
+        if self.closestack and token.equals(self.closestack[-1]):
+            self.close_node()
+
+
 class ParseTable:  # LL(1) Parsing
     def __init__(self):
-        self.entries = {}  # {(nonterminal, Token) : Production, ...}
+        self.entries = {}  # {(nonterminal, token kind) : Production, ...}
         self.nodables = set()
 
     def register_entry(self, coord, rhs, nodable=False):
-        '''Add a cell to the table.'''
-        self.entries[coord] = rhs  # RHS should be list of tokens or production names
+        '''
+        Add a cell to the table. coord is (nonterminal, Token); cells are indexed by
+        the token's kind. Raises a ParserException if the cell already holds a
+        different production.
+        '''
+        nonterm, terminal = coord
+        key = (nonterm, terminal.kind)
+        if key in self.entries and self.entries[key] != rhs:
+            raise ParserException(f"Conflicting productions for {nonterm} on {terminal}: {self.entries[key]} and {rhs}")
+        self.entries[key] = rhs  # RHS should be list of tokens or production names
         if nodable:
             self.nodables.add(rhs)
 
@@ -110,12 +237,7 @@ class ParseTable:  # LL(1) Parsing
         Returns production to take given current nonterminal and lookahead.
         If entry is not found, return None. Caller handles error.
         '''
-        # print(f"Fetching: {nonterm, lookahead}")
-        for e in self.entries.keys():
-            # print(e, lookahead)
-            if e[0] == nonterm and lookahead.equals(e[1]):
-                return self.entries[e]
-        return None
+        return self.entries.get((nonterm, lookahead.kind))
     
     def get_nodables(self):
         return self.nodables
@@ -154,6 +276,94 @@ class TokenNodeAST:
         return f"{self.tok.text}"
 
 
+class ArenaAST:
+    """
+    Compact AST held in flat arrays. Node i has a label id (0 for token leaves), a
+    parent, first child and next sibling (-1 if none) and, for leaves, the index of
+    its token in the parser input. view(i) gives node-like access for consumers
+    written against ProductionNodeAST/TokenNodeAST.
+    """
+    def __init__(self, tokens, root_label):
+        self.tokens = tokens  # Parser input the leaves refer to
+        self.label_names = [None]  # Label id -> production label
+        self.label_ids = {}
+        self.labels = array('B')
+        self.parents = array('i')
+        self.firsts = array('i')
+        self.nexts = array('i')
+        self.lasts = array('i')  # Last child, for appending in O(1)
+        self.toks = array('i')
+        self.add(-1, root_label)
+
+    def add(self, parent, label=None, tok=-1):
+        '''Appends a node under parent: a production if label is given, else the leaf for token tok.'''
+        node = len(self.labels)
+        if label is None:
+            self.labels.append(0)
+        else:
+            if label not in self.label_ids:
+                self.label_ids[label] = len(self.label_names)
+                self.label_names.append(label)
+            self.labels.append(self.label_ids[label])
+        self.parents.append(parent)
+        self.firsts.append(-1)
+        self.nexts.append(-1)
+        self.lasts.append(-1)
+        self.toks.append(tok)
+
+        if parent >= 0:
+            if self.lasts[parent] < 0:
+                self.firsts[parent] = node
+            else:
+                self.nexts[self.lasts[parent]] = node
+            self.lasts[parent] = node
+        return node
+
+    def child_ids(self, node):
+        child = self.firsts[node]
+        while child >= 0:
+            yield child
+            child = self.nexts[child]
+
+    def view(self, node):
+        if self.labels[node]:
+            return ArenaNodeView(self, node)
+        return ArenaTokenView(self, node)
+
+    def __len__(self):
+        return len(self.labels)
+
+
+class ArenaNodeView(ProductionNodeAST):
+    """ProductionNodeAST-compatible view of an arena node"""
+    def __init__(self, arena, node):
+        self.arena = arena
+        self.node = node
+
+    @property
+    def value(self):
+        return self.arena.label_names[self.arena.labels[self.node]]
+
+    @property
+    def children(self):
+        return [self.arena.view(c) for c in self.arena.child_ids(self.node)]
+
+
+class ArenaTokenView(TokenNodeAST):
+    """TokenNodeAST-compatible view of an arena leaf"""
+    def __init__(self, arena, node):
+        self.arena = arena
+        self.node = node
+
+    @property
+    def tok(self):
+        return self.arena.tokens[self.arena.toks[self.node]]
+
+    @property
+    def children(self):
+        return []
+
+
 def print_ast(node, level=0, is_last=True, prefix=""):
     if level == 0:
         print(repr(node))
@@ -170,4 +380,4 @@ def print_ast(node, level=0, is_last=True, prefix=""):
 
 
 class ParserException(Exception):
-    pass
\ No newline at end of file
+    pass
\ No newline at end of file
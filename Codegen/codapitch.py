@@ -0,0 +1,33 @@
+# Pitch classes of note letters and the semitones added by accidentals (ex. C#1 is 13 and Cb1 is 11)
+PITCH_CLASSES = {"C": 0, "D": 2, "E": 4, "F": 5, "G": 7, "A": 9, "B": 11}
+ACCIDENTALS = {"": 0, "#": 1, "b": -1}
+
+# Chord Intervals - Semitones above the root of major (+) and minor (-) triads
+CHORD_INTERVALS = {"+": (0, 4, 7), "-": (0, 3, 7)}
+
+
+def text_pitches(text):
+    '''
+    Returns the MIDI note numbers named by the text of a NOTE (ex. Db4), CHORD (ex. C#-5*)
+    or REST token, or None if the text names no pitch. A chord's root is the note of the
+    same name, and its other notes take the root's octave digit, so F+4* is F4 A4 C4.
+    '''
+    if text == '_':
+        return ()
+    if text[-1] == '*':  # Is a chord
+        if len(text) < 4 or text[-3] not in CHORD_INTERVALS:
+            return None
+        name, intervals, octave = text[:-3], CHORD_INTERVALS[text[-3]], text[-2]
+    else:
+        name, intervals, octave = text[:-1], None, text[-1]
+
+    letter = PITCH_CLASSES.get(name[:1])
+    accidental = ACCIDENTALS.get(name[1:])
+    if letter is None or accidental is None or not octave.isdigit():  # Ex. R4, or C# cut off by the end of input
+        return None
+    base = 12 * int(octave)  # C1 is 12
+    root = base + letter + accidental  # Cb4 and B#4 cross into the neighbouring octave
+    if intervals is None:
+        return (root,)
+    # The root sounds where the same note would; only the upper notes wrap into the octave
+    return (root,) + tuple(base + (letter + accidental + interval) % 12 for interval in intervals[1:])
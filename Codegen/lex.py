@@ -1,4 +1,5 @@
 from codalexer import Lexer, Regex
+from codapitch import text_pitches
 
 note_stages = {
     0: ['A', 'B', 'C', 'D', 'E', 'F', 'G', 'R'],
@@ -47,13 +48,15 @@ rbracket_stages = {0: ']'}
 lexer = Lexer()
 lexer.register_token(Regex('NOTE', "['A'-'G']['#', 'b']?[1-7]",
                            note_stages,
-                           optionals=note_opts))
+                           optionals=note_opts,
+                           resolve=text_pitches))
 lexer.register_token(Regex('KEY', "['A'-'G']['#', 'b']?['-', '+']?", 
                            key_stages, 
                            optionals=key_opts))
 lexer.register_token(Regex('CHORD', "['A'-'G']['#', 'b']?[1-7]", 
                            chord_stages, 
-                           optionals=chord_opts))
+                           optionals=chord_opts,
+                           resolve=text_pitches))
 lexer.register_token(Regex('CONNECTOR', "['>']['>']?", 
                            connector_stages, 
                            optionals=connector_opts,
@@ -64,7 +67,7 @@ lexer.register_token(Regex('COMMENT', "['//']['A'-'Z''a'-'z']*['\n']", comment_s
 lexer.register_token(Regex('NUMBER', "['1'-'9']", num_stages, 
                            repeats=num_reps))
 lexer.register_token(Regex('DECLARATOR', "'!'", declarator_stages, single=True))
-lexer.register_token(Regex('REST', "'_'", rest_stages, single=True))
+lexer.register_token(Regex('REST', "'_'", rest_stages, single=True, resolve=text_pitches))
 lexer.register_token(Regex('SEPARATOR', "','", separator_stages, single=True))
 lexer.register_token(Regex('LBRACE', "'{'", lbrace_stages, single=True))
 lexer.register_token(Regex('RBRACE', "'}'", rbrace_stages, single=True))
@@ -75,4 +78,5 @@ lexer.register_token(Regex('KEYWORD', "['sig']", kw_sig_stages))
 lexer.register_token(Regex('KEYWORD', "['typ']", kw_typ_stages))
 lexer.register_token(Regex('KEYWORD', "['rep']", kw_rep_stages))
 lexer.register_token(Regex('KEYWORD', "['grp']", kw_grp_stages))
-lexer.register_token(Regex('KEYWORD', "['tmp']", kw_tmp_stages))
\ No newline at end of file
+lexer.register_token(Regex('KEYWORD', "['tmp']", kw_tmp_stages))
+lexer.compile()
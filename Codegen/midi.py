@@ -1,5 +1,20 @@
+import io
+from itertools import chain, groupby
+from operator import attrgetter
 import struct
 
+from codair import NOTE_EVENT, CHORD_EVENT, GROUP_EVENT, REST_EVENT, REPEAT_EVENT, END_REPEAT_EVENT, RestEvent, duration, expand
+
+try:
+    import numpy as np
+except ImportError:  # Optional; only the 'numpy' backend needs it
+    np = None
+
+BACKENDS = ('python', 'numpy')
+AVAILABLE_BACKENDS = BACKENDS if np is not None else ('python',)
+
+FLUSH_SIZE = 1 << 16  # Encoded bytes a streaming TrackChunk buffers before writing
+
 def encode_vlq(value):
     '''Encodes an integer into a Variable-Length Quantity (VLQ)'''
     buffer = value & 0x7F
@@ -18,9 +33,9 @@ def encode_vlq(value):
 class HeaderChunk:
     '''MIDI Header Chunk'''
     ID = b"MThd"
-    def __init__(self, tpq=480):
-        self.fmt = 0
-        self.ntracks = 1
+    def __init__(self, tpq=480, fmt=0, ntracks=1):
+        self.fmt = fmt  # 0: one track, 1: simultaneous tracks
+        self.ntracks = ntracks
         self.div = tpq
 
     def bytes(self):
@@ -34,8 +49,15 @@ class HeaderChunk:
 class TrackChunk:
     '''MIDI Track Chunk'''
     ID = b"MTrk"
-    def __init__(self, tpq=480):
-        self.events = b""
+    def __init__(self, tpq=480, out=None):
+        self.events = bytearray()  # Encoded events not yet written to out
+        self.out = out  # Binary file to stream events to, or None to keep them all
+        self.written = 0  # Bytes already flushed to out
+        self.templates = {}  # (pitches, ticks) -> note-on/note-off bytes after the first delta
+        self.deltas = {0: encode_vlq(0)}  # Rest ticks -> VLQ
+        self.lead = None  # Delta before the first note-on in events, once there is one
+        self.body = 0  # Index in events just past that delta
+        self.repeats = []  # Enclosing sections' saved state while a repeat is encoded
         self.tpq = tpq
         self.rest_ticks = 0  # For properly tracking rests
 
@@ -47,73 +69,73 @@ class TrackChunk:
 
     def add_note(self, note, dur):
         '''Adds a note (as an object of class Token) for a given duration (in beats)'''
-        note = note.text
-        ticks_duration = int(dur*self.tpq)  # Convert beats to ticks
-
-        if note == '_':  # On rest, increment current delay and continue
-            self.rest_ticks += int(dur*self.tpq)
-            return
-
-        note_number = NOTE_MAP[note]
-        # Note-on event
-        self.events += encode_vlq(self.rest_ticks)  # For proper rest behavior
-        self.events += struct.pack(">BBB", 0x90, note_number, 64)  # Note-on (velocity 64)
-        self.rest_ticks = 0
+        kind = REST_EVENT if note.text == '_' else NOTE_EVENT
+        self.add_event(kind, token_pitches(note), int(dur*self.tpq))  # Convert beats to ticks
 
-        # Note-off event
-        self.events += encode_vlq(ticks_duration)  # Delta time
-        self.events += struct.pack(">BBB", 0x80, note_number, 0)  # Note-off (velocity 0)
-    
     def add_chord(self, chord, dur):
         '''Adds a chord (as an object class Token) for a given duration (in beats)'''
-        chord = chord.text  # Ex: C+5*
-        base, oct = chord[:-2], chord[-2]
-        notes = CHORD_MAP[base]  # ["C", "E", "G"]
-
-        self.events += encode_vlq(self.rest_ticks)  # Apply rest before playing the chord
-        self.events += struct.pack(">BBB", 0x90, NOTE_MAP[notes[0]+oct], 64)
-        for note in notes[1:]:
-            note_num = NOTE_MAP[note + oct]
-            self.events += encode_vlq(0)  # Same time as other notes
-            self.events += struct.pack(">BBB", 0x90, note_num, 64)  # Note-on, velocity 64
-
-        self.rest_ticks = 0
+        self.add_event(CHORD_EVENT, token_pitches(chord), int(dur * self.tpq))
 
-        self.events += encode_vlq(int(dur * self.tpq))  # Delta time for chord duration
-        self.events += struct.pack(">BBB", 0x80, NOTE_MAP[notes[0]+oct], 0)
-        for note in notes[1:]:
-            note_num = NOTE_MAP[note + oct]
-            self.events += encode_vlq(0)
-            self.events += struct.pack(">BBB", 0x80, note_num, 0)  # Note-off, velocity 0
-    
     def add_group(self, notelist, dur):  # notes in list encoded in same format as in add_note
-        # First expand any chords in the notelist
-        expanded_notes = []
+        pitches = ()
         for n in notelist:
-            if n.text[-1] == '*':  # Is a chord
-                base, oct = n.text[:-2], n.text[-2]
-                bases = CHORD_MAP[base]
-                expanded_notes += [b+oct for b in bases]
-            else:
-                expanded_notes.append(n.text)
+            pitches += token_pitches(n)
+        self.add_event(GROUP_EVENT, pitches, int(dur * self.tpq))
+
+    def add_event(self, kind, pitches, ticks):
+        '''Adds an event whose pitches (a tuple) all start together and last for ticks'''
+        if kind == REST_EVENT:  # On rest, increment current delay and continue
+            self.rest_ticks += ticks
+            return
 
-        notelist = expanded_notes
+        template = self.templates.get((pitches, ticks))
+        if template is None:
+            template = self.templates[pitches, ticks] = note_template(pitches, ticks)
+        self.add_delta(self.rest_ticks)  # Apply rest before playing the notes
+        self.events += template
+        self.rest_ticks = 0
+
+        if self.out is not None and len(self.events) >= FLUSH_SIZE and not self.repeats:
+            self.flush()
 
-        self.events += encode_vlq(self.rest_ticks)  # Apply rest before playing the chord
-        self.events += struct.pack(">BBB", 0x90, NOTE_MAP[notelist[0]], 64)
-        for note in notelist[1:]:
-            note_num = NOTE_MAP[note]
-            self.events += encode_vlq(0)  # Same time as other notes
-            self.events += struct.pack(">BBB", 0x90, note_num, 64)  # Note-on, velocity 64
+    def add_delta(self, ticks):
+        '''Adds the delta time before a note-on'''
+        delta = self.deltas.get(ticks)
+        if delta is None:
+            delta = self.deltas[ticks] = encode_vlq(ticks)
+        self.events += delta
+        if self.lead is None:
+            self.lead = ticks
+            self.body = len(self.events)
 
+    def begin_repeat(self, count):
+        '''Starts a section that end_repeat() adds count times'''
+        self.repeats.append((self.events, self.rest_ticks, self.lead, self.body, count))
+        self.events = bytearray()
         self.rest_ticks = 0
+        self.lead = None
+
+    def end_repeat(self):
+        '''
+        Adds the section started by begin_repeat() count times. Its events are
+        encoded once, and each copy only changes the delta before its first note,
+        which includes the rest pending before that copy.
+        '''
+        section, trailing, lead, body = self.events, self.rest_ticks, self.lead, self.body
+        self.events, self.rest_ticks, self.lead, self.body, count = self.repeats.pop()
+        if lead is None:  # Only rests
+            self.rest_ticks += trailing * count
+            return
 
-        self.events += encode_vlq(int(dur * self.tpq))  # Delta time for chord duration
-        self.events += struct.pack(">BBB", 0x80, NOTE_MAP[notelist[0]], 0)
-        for note in notelist[1:]:
-            note_num = NOTE_MAP[note]
-            self.events += encode_vlq(0)
-            self.events += struct.pack(">BBB", 0x80, note_num, 0)  # Note-off, velocity 0
+        section = memoryview(section)[body:]
+        self.add_delta(self.rest_ticks + lead)
+        self.events += section
+        copy = encode_vlq(trailing + lead) + section
+        for _ in range(count - 1):
+            self.events += copy
+            if self.out is not None and len(self.events) >= FLUSH_SIZE and not self.repeats:
+                self.flush()
+        self.rest_ticks = trailing
 
     def add_meta_event(self, meta_type, data):
         '''Adds a meta event'''
@@ -121,112 +143,264 @@ class TrackChunk:
         self.events += struct.pack(">BB", 0xFF, meta_type)  # Meta type
         self.events += struct.pack(">B", len(data)) + data  # Meta event length and data
 
+    def add_tempo(self, tempo):
+        '''Adds a Set Tempo meta-event for tempo in beats per minute'''
+        tempo_data = struct.pack(">I", int(60000000 / tempo))[1:]
+        self.add_meta_event(0x51, tempo_data)
+
+    def add_events(self, events, backend='python'):
+        '''Adds a stream of IR events using the given MidiGenerator backend'''
+        if backend == 'numpy':
+            self.events += encode_events_numpy(events)
+            return
+
+        for event in events:
+            kind = event.kind
+            if kind == REPEAT_EVENT:
+                self.begin_repeat(event.count)
+            elif kind == END_REPEAT_EVENT:
+                self.end_repeat()
+            else:
+                self.add_event(kind, event.pitches, event.ticks)
+
     def end_track(self):
         '''Adds the End of Track meta-event'''
         self.add_meta_event(0x2F, b"")
 
+    def flush(self):
+        '''Writes the buffered events to out'''
+        self.out.write(self.events)
+        self.written += len(self.events)
+        self.events.clear()
+
     def bytes(self):
         '''Returns the binary representation of the track chunk'''
         chunk_length = len(self.events)
         return struct.pack(">4sI", self.ID, chunk_length) + self.events
 
+def check_backend(backend):
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown MIDI backend '{backend}', expected one of {', '.join(BACKENDS)}")
+    if backend == 'numpy' and np is None:
+        raise ImportError("The numpy MIDI backend requires NumPy to be installed")
+
+
 class MidiGenerator:
-    def __init__(self, tempo, note_seq, dur_seq, tpq=480):
+    '''
+    Encodes a stream of IR events (see codair) as a single-track MIDI file. The
+    'python' backend encodes events through TrackChunk as they are produced. The
+    'numpy' backend collects them into arrays and encodes the track in bulk.
+    '''
+    def __init__(self, tempo, events, tpq=480, backend='python'):
+        check_backend(backend)
         self.header = HeaderChunk(tpq)
         self.track = TrackChunk(tpq)
-        self.note_seq = note_seq
-        self.dur_seq = dur_seq
+        self.events = events
         self.tempo = tempo
+        self.backend = backend
     
     def generate(self, fname):
-        tempo_data = struct.pack(">I", int(60000000 / self.tempo))[1:]
-        self.track.add_meta_event(0x51, tempo_data)
-
-        skipped = []
-        dur_ind = 0
-        for num, note in enumerate(self.note_seq):
-            if num in skipped:
-                continue
-
-            if not isinstance(note, int):
-                self.track.add(note, self.dur_seq[dur_ind])
-            else:  # is a group; value says number of notes to include
-                cnt = note
-                self.track.add_group(self.note_seq[num+1:num+1+cnt], self.dur_seq[num])
-                skipped += [r for r in range(num+1, num+1+cnt)]
-            dur_ind += 1
+        with open(f'{fname}.midi', "wb") as midi:
+            self.write(midi)
+
+    def encode(self):
+        '''Encodes the event stream and returns the complete MIDI file as bytes'''
+        midi = io.BytesIO()
+        self.write(midi)
+        return midi.getvalue()
+
+    def write(self, out):
+        '''
+        Encodes the event stream into the binary file out. A seekable file receives
+        the track as it is encoded, with the MTrk length patched in at the end; any
+        other file (a pipe, for instance) gets the whole MIDI file in one write.
+        Files opened for appending ignore seeks, so they must not be passed here.
+        '''
+        if not out.seekable():
+            midi = io.BytesIO()
+            self.write(midi)
+            out.write(midi.getbuffer())
+            return
 
+        out.write(self.header.bytes())
+        start = out.tell()
+        out.write(struct.pack(">4sI", TrackChunk.ID, 0))  # Placeholder length
+        self.track.out = out
+        self.encode_track()
+        self.track.flush()
+
+        end = out.tell()
+        out.seek(start + 4)
+        out.write(struct.pack(">I", end - start - 8))
+        out.seek(end)
+
+    def encode_track(self):
+        '''Adds the tempo, every event and the end of track to the track chunk'''
+        self.track.add_tempo(self.tempo)
+        self.track.add_events(self.events, self.backend)
         self.track.end_track()
 
+
+class MultiTrackGenerator:
+    '''
+    Encodes a format 1 MIDI file: a tempo track followed by one track per section.
+    Sections are IR sequences (see codair) that play one after another, so each
+    track starts with a rest lasting until its section begins. Tracks are encoded
+    independently, in parallel when an executor is given, and written in order.
+    '''
+    def __init__(self, tempo, sections, tpq=480, backend='python', executor=None):
+        check_backend(backend)
+        self.header = HeaderChunk(tpq, fmt=1, ntracks=len(sections) + 1)
+        self.tempo = tempo
+        self.sections = sections
+        self.tpq = tpq
+        self.backend = backend
+        self.executor = executor
+
+    def generate(self, fname):
         with open(f'{fname}.midi', "wb") as midi:
-            midi.write(self.header.bytes())
-            midi.write(self.track.bytes())
-
-
-# Note Map - Maps text notes from C1 to B7 (sharps specified as ex. C#1 and flats as ex. Cb1)
-NOTE_MAP = {
-    # Octave 1
-    "C1": 12, "C#1": 13, "Db1": 13, "D1": 14, "D#1": 15, "Eb1": 15,
-    "E1": 16, "F1": 17, "F#1": 18, "Gb1": 18, "G1": 19, "G#1": 20, "Ab1": 20,
-    "A1": 21, "A#1": 22, "Bb1": 22, "B1": 23,
-    # Octave 2
-    "C2": 24, "C#2": 25, "Db2": 25, "D2": 26, "D#2": 27, "Eb2": 27,
-    "E2": 28, "F2": 29, "F#2": 30, "Gb2": 30, "G2": 31, "G#2": 32, "Ab2": 32,
-    "A2": 33, "A#2": 34, "Bb2": 34, "B2": 35,
-    # Octave 3
-    "C3": 36, "C#3": 37, "Db3": 37, "D3": 38, "D#3": 39, "Eb3": 39,
-    "E3": 40, "F3": 41, "F#3": 42, "Gb3": 42, "G3": 43, "G#3": 44, "Ab3": 44,
-    "A3": 45, "A#3": 46, "Bb3": 46, "B3": 47,
-    # Octave 4
-    "C4": 48, "C#4": 49, "Db4": 49, "D4": 50, "D#4": 51, "Eb4": 51,
-    "E4": 52, "F4": 53, "F#4": 54, "Gb4": 54, "G4": 55, "G#4": 56, "Ab4": 56,
-    "A4": 57, "A#4": 58, "Bb4": 58, "B4": 59,
-    # Octave 5
-    "C5": 60, "C#5": 61, "Db5": 61, "D5": 62, "D#5": 63, "Eb5": 63,
-    "E5": 64, "F5": 65, "F#5": 66, "Gb5": 66, "G5": 67, "G#5": 68, "Ab5": 68,
-    "A5": 69, "A#5": 70, "Bb5": 70, "B5": 71,
-    # Octave 6
-    "C6": 72, "C#6": 73, "Db6": 73, "D6": 74, "D#6": 75, "Eb6": 75,
-    "E6": 76, "F6": 77, "F#6": 78, "Gb6": 78, "G6": 79, "G#6": 80, "Ab6": 80,
-    "A6": 81, "A#6": 82, "Bb6": 82, "B6": 83,
-    # Octave 7
-    "C7": 84, "C#7": 85, "Db7": 85, "D7": 86, "D#7": 87, "Eb7": 87,
-    "E7": 88, "F7": 89, "F#7": 90, "Gb7": 90, "G7": 91, "G#7": 92, "Ab7": 92,
-    "A7": 93, "A#7": 94, "Bb7": 94, "B7": 95
-}
-
-# Chord Map - Maps chords to lists of notes from C1 to C5 (supports major and minor | Ex. C-sharp major = C#+ and C-flat minor = ex. Cb-)
-CHORD_MAP = {
-    "C+": ["C", "E", "G"],
-    "C-": ["C", "Eb", "G"],
-    "C#+": ["C#", "F", "G#"],
-    "C#-": ["C#", "E", "G#"],
-    "D+": ["D", "F#", "A"],
-    "D-": ["D", "F", "A"],
-    "D#+": ["D#", "G", "A#"],
-    "D#-": ["D#", "F#", "A#"],
-    "E+": ["E", "G#", "B"],
-    "E-": ["E", "G", "B"],
-    "F+": ["F", "A", "C"],
-    "F-": ["F", "Ab", "C"],
-    "F#+": ["F#", "A#", "C#"],
-    "F#-": ["F#", "A", "C#"],
-    "G+": ["G", "B", "D"],
-    "G-": ["G", "Bb", "D"],
-    "G#+": ["G#", "C", "D#"],
-    "G#-": ["G#", "B", "D#"],
-    "A+": ["A", "C#", "E"],
-    "A-": ["A", "C", "E"],
-    "A#+": ["A#", "D", "F"],
-    "A#-": ["A#", "C#", "F"],
-    "B+": ["B", "D#", "F#"],
-    "B-": ["B", "D", "F#"]
-}
-
-# from parse import Token
-# nseq = [Token('NOTE', 'F4'), Token('CHORD', 'C+5*'), 2, Token('CHORD', 'C+5*'), Token('NOTE', 'B5')]
-# dseq = [1, 1, 3]
+            self.write(midi)
+
+    def encode(self):
+        '''Encodes every track and returns the complete MIDI file as bytes'''
+        tempo_track = TrackChunk(self.tpq)
+        tempo_track.add_tempo(self.tempo)
+        tempo_track.end_track()
+
+        offsets = []
+        start = 0
+        for section in self.sections:
+            offsets.append(start)
+            start += duration(section)
+        jobs = (self.sections, offsets, [self.tpq] * len(offsets), [self.backend] * len(offsets))
+        if self.executor is None:
+            tracks = map(encode_section, *jobs)
+        else:
+            tracks = self.executor.map(encode_section, *jobs)
+        return b''.join([self.header.bytes(), tempo_track.bytes(), *tracks])
+
+    def write(self, out):
+        '''Encodes the file into the binary file out'''
+        out.write(self.encode())
+
+
+def encode_section(section, offset, tpq=480, backend='python'):
+    '''Returns the track chunk for one section starting offset ticks into the piece'''
+    track = TrackChunk(tpq)
+    track.add_events(chain([RestEvent(offset)], expand(section, repeats=True)), backend)
+    track.end_track()
+    return track.bytes()
+
+
+def event_arrays(events):
+    '''
+    Returns NumPy arrays of the ticks, pitch count and pitches (flattened) of each
+    event. Runs of events between repeat markers are converted in bulk, and each
+    repeated section is converted once and tiled.
+    '''
+    dtypes = (np.int64, np.int64, np.uint8)
+    section = ([], [], [])  # Arrays collected for the innermost open section
+    repeats = []  # Enclosing sections and repeat counts
+    for markers, run in groupby(events, attrgetter('repeat_marker')):
+        if not markers:
+            run = list(run)
+            chords = list(map(attrgetter('pitches'), run))
+            section[0].append(np.fromiter(map(attrgetter('ticks'), run), np.int64, len(run)))
+            section[1].append(np.fromiter(map(len, chords), np.int64, len(run)))
+            section[2].append(np.fromiter(chain.from_iterable(chords), np.uint8))
+            continue
+
+        for marker in run:
+            if marker.kind == REPEAT_EVENT:
+                repeats.append((section, marker.count))
+                section = ([], [], [])
+            else:
+                outer, count = repeats.pop()
+                for arrays, parts, dtype in zip(outer, section, dtypes):
+                    arrays.append(np.tile(concatenate(parts, dtype), count))
+                section = outer
+    return tuple(concatenate(parts, dtype) for parts, dtype in zip(section, dtypes))
+
+
+def concatenate(arrays, dtype):
+    return np.concatenate(arrays) if arrays else np.empty(0, dtype)
+
+
+def encode_events_numpy(events):
+    '''
+    Returns the encoded track events for an event stream, computed with NumPy.
+    Produces the same bytes as TrackChunk.add_event over the same events.
+    '''
+    ticks, counts, pitches = event_arrays(events)
+
+    # Rests only move the start of the next sounding event
+    starts = np.cumsum(ticks) - ticks
+    sounding = counts > 0
+    ticks, counts, starts = ticks[sounding], counts[sounding], starts[sounding]
+    ends = starts + ticks
+    rests = starts - np.concatenate(([0], ends[:-1]))  # Delta before each first note-on
+
+    # One note-on and one note-off per pitch: an event's note-ons, then its note-offs
+    first_pitch = np.cumsum(counts) - counts
+    owner = np.repeat(np.arange(len(counts)), counts)
+    index = np.arange(len(pitches)) - first_pitch[owner]  # Position within the event
+    first = index == 0
+    on = 2 * first_pitch[owner] + index
+    off = on + counts[owner]
+
+    size = 2 * len(pitches)
+    deltas = np.empty(size, dtype=np.int64)
+    deltas[on] = np.where(first, rests[owner], 0)
+    deltas[off] = np.where(first, ticks[owner], 0)
+    lengths = np.ones(size, dtype=np.int64)  # VLQ bytes per delta
+    high = deltas >> 7
+    while high.any():
+        lengths += high > 0
+        high >>= 7
+
+    # One row per message: its VLQ right-aligned in the first width columns,
+    # then status, note and velocity. Unused leading cells are dropped at the end.
+    width = int(lengths.max(initial=1))
+    rows = np.empty((size, width + 3), dtype=np.uint8)
+    for group in range(width):  # Least significant 7 bits go in the last column
+        bits = (deltas >> (7 * group)) & 0x7F
+        rows[:, width - 1 - group] = bits | 0x80 if group else bits
+    rows[on, width] = 0x90
+    rows[off, width] = 0x80
+    rows[on, width + 1] = pitches
+    rows[off, width + 1] = pitches
+    rows[on, width + 2] = 64
+    rows[off, width + 2] = 0
+    used = np.arange(width + 3) >= (width - lengths)[:, None]
+    body = rows[used]
+    return body.tobytes()
+
+
+def note_template(pitches, ticks):
+    '''
+    Returns the bytes of an event's note-ons and note-offs, minus the delta before
+    the first note-on: the pitches start together (velocity 64) and end ticks later
+    '''
+    template = bytearray((0x90, pitches[0], 64))
+    for pitch in pitches[1:]:
+        template += bytes((0, 0x90, pitch, 64))  # Same time as other notes
+
+    template += encode_vlq(ticks)  # Delta time for the duration
+    template += bytes((0x80, pitches[0], 0))
+    for pitch in pitches[1:]:
+        template += bytes((0, 0x80, pitch, 0))
+    return bytes(template)
+
+
+def token_pitches(token):
+    '''Returns the MIDI note numbers sounded by a NOTE, CHORD or REST token, resolved when it was lexed'''
+    if token.resolved is None:  # Spelling with no pitch, ex. R4
+        raise KeyError(token.text)
+    return token.resolved
+
+
+# events = [NoteEvent((53,), 480), ChordEvent((60, 64, 67), 480), RestEvent(960)]
 # tempo = 120
 
-# gen = MidiGenerator(tempo, nseq, dseq)
-# gen.generate('demo')
\ No newline at end of file
+# gen = MidiGenerator(tempo, events)
+# gen.generate('demo')